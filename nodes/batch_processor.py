@@ -11,7 +11,7 @@ try:
         call_nano_banana_api,
         process_api_response,
         pil_to_comfy_image,
-        comfy_image_to_base64,
+        comfy_images_to_base64,
         load_images_from_folder,
         save_image_to_folder,
         format_time,
@@ -25,7 +25,7 @@ except ImportError:
         call_nano_banana_api,
         process_api_response,
         pil_to_comfy_image,
-        comfy_image_to_base64,
+        comfy_images_to_base64,
         load_images_from_folder,
         save_image_to_folder,
         format_time,
@@ -243,7 +243,7 @@ class NanoBananaBatchProcessor:
                         all_refs = fixed_refs + [current_image_tensor]
                         
                         # 转换为base64
-                        ref_base64_list = [comfy_image_to_base64(ref) for ref in all_refs]
+                        ref_base64_list = comfy_images_to_base64(all_refs)
                         
                         # 处理种子参数
                         seed_param = None if current_seed < 0 else current_seed
@@ -12,7 +12,7 @@ try:
         call_nano_banana_api,
         process_api_response,
         pil_to_comfy_image,
-        comfy_image_to_base64,
+        comfy_images_to_base64,
         resize_image_to_max_dim,
         UPSCALE_METHODS,
         MAX_DIM_OPTIONS,
@@ -23,7 +23,7 @@ except ImportError:
         call_nano_banana_api,
         process_api_response,
         pil_to_comfy_image,
-        comfy_image_to_base64,
+        comfy_images_to_base64,
         resize_image_to_max_dim,
         UPSCALE_METHODS,
         MAX_DIM_OPTIONS,
@@ -233,10 +233,7 @@ class NanoBananaImageToImage:
             logger.debug(f"Total reference images: {num_references}, Batch size: {batch_size}")
             
             # ========== 阶段1: 图片转 Base64（不输出，耗时极少）==========
-            reference_base64_list = []
-            for ref_img in reference_images:
-                b64 = comfy_image_to_base64(ref_img)
-                reference_base64_list.append(b64)
+            reference_base64_list = comfy_images_to_base64(reference_images)
             
             # 记录开始时间
             _t_start = time.time()
@@ -2,18 +2,84 @@
 Utility functions for Gemini Nano Banana API integration
 Uses official Gemini API format for full compatibility
 """
+import asyncio
 import requests
+from requests.adapters import HTTPAdapter
 import base64
+import email.utils
 import io
 import json
 import numpy as np
 import torch
+import torch.nn.functional as F
+import PIL
 from PIL import Image
 import time
 import logging
+import fnmatch
+import hashlib
+import functools
+import itertools
 import os
-import glob
+import queue
+import random
+import re
+import ssl
+import sys
+import threading
 from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import MappingProxyType
+from urllib.parse import urlsplit
+
+# 可选依赖：requests-toolbelt 用于流式 multipart 上传，未安装时回退到 requests 的 files 参数
+try:
+    from requests_toolbelt.multipart.encoder import MultipartEncoder
+except ImportError:
+    MultipartEncoder = None
+
+# 可选依赖：pybase64 提供 SIMD 加速的 base64 编解码（接口与标准库兼容），未安装时回退到标准库
+try:
+    import pybase64 as _b64
+    _b64encode_as_string = _b64.b64encode_as_string
+except ImportError:
+    _b64 = base64
+    
+    def _b64encode_as_string(data):
+        return base64.b64encode(data).decode('ascii')
+
+# 可选依赖：orjson 直接解析 bytes 且速度更快，未安装时回退到标准库 json
+# （标准库 json.loads 同样接受 bytes；orjson.JSONDecodeError 是 json.JSONDecodeError 的子类）
+# 请求体序列化同理：orjson.dumps 直接输出 UTF-8 bytes，回退时输出等价的紧凑 JSON bytes
+try:
+    from orjson import loads as _json_loads, dumps as _json_dumps
+except ImportError:
+    _json_loads = json.loads
+    
+    def _json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# 可选依赖：torchvision 的 decode_jpeg 可在 CUDA 上通过 nvJPEG 解码（ComfyUI 环境通常自带 torchvision）
+try:
+    from torchvision.io import decode_jpeg as _decode_jpeg, ImageReadMode as _ImageReadMode
+except ImportError:
+    _decode_jpeg = None
+
+# 可选依赖：PyTurboJPEG 直接调用 libjpeg-turbo 编码 JPEG，比经由 PIL 编码快数倍
+# （需要系统中安装 libjpeg-turbo 动态库，找不到时 TurboJPEG() 会抛出异常）
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    _TURBOJPEG = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _TURBOJPEG = None
+
+# 可选依赖：在 ComfyUI 中运行时，重试等待期间响应用户在界面上的取消操作
+try:
+    from comfy.model_management import throw_exception_if_processing_interrupted as _check_interrupted
+except ImportError:
+    def _check_interrupted():
+        pass
 
 # 禁用 SSL 警告（Origin Certificate 是自签名证书，这是正常的）
 import urllib3
@@ -23,10 +89,21 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Pillow-SIMD 是 Pillow 的直接替代（pip uninstall pillow && pip install pillow-simd），
+# 解码、缩放和色彩转换使用 SSE4/AVX2 加速，调用代码无需任何修改；其版本号带 ".postN" 后缀
+PILLOW_VERSION = getattr(PIL, "__version__", "unknown")
+PILLOW_SIMD = ".post" in PILLOW_VERSION
+logger.debug("Pillow %s (SIMD: %s)", PILLOW_VERSION, "是" if PILLOW_SIMD else "否")
+
 # ============================================================
 # API 基础地址配置（由配置节点提供）
 # ============================================================
 API_BASE_URL = "https://api.o1key.com"  # 默认地址
+
+# 接口路径（线路地址由配置节点动态传入，只有路径部分是固定的）
+_PATH_IMAGES_GENERATIONS = "/v1/images/generations"
+_PATH_IMAGES_EDITS = "/v1/images/edits"
+_PATH_GEMINI_GENERATE_FMT = "/v1beta/models/{}:generateContent"
 # ============================================================
 
 # ============================================================
@@ -44,6 +121,153 @@ PROXY_URL = None  # 不使用代理（测试直连新加坡）
 PROXIES = {"http": PROXY_URL, "https": PROXY_URL} if PROXY_URL else None
 # ============================================================
 
+# ============================================================
+# 参考图上传编码配置
+# ============================================================
+# PNG 的 zlib 压缩级别 (0-9)：上传前的临时编码默认使用最快的 1
+# （默认 6 编码耗时数倍，体积仅小约 15%）；上传带宽受限时可通过环境变量调高
+try:
+    PNG_COMPRESS_LEVEL = min(9, max(0, int(os.environ.get("O1KEY_PNG_COMPRESS_LEVEL", "1"))))
+except ValueError:
+    PNG_COMPRESS_LEVEL = 1
+# ============================================================
+
+# ============================================================
+# 图片保存编码配置
+# ============================================================
+# 保存到文件夹的 PNG 的 zlib 压缩级别 (0-9)：与上传编码分开配置，互不影响
+# 默认使用最快的 1；需要更小的输出文件时可通过环境变量调高
+try:
+    SAVE_PNG_COMPRESS_LEVEL = min(9, max(0, int(os.environ.get("O1KEY_SAVE_PNG_COMPRESS_LEVEL", "1"))))
+except ValueError:
+    SAVE_PNG_COMPRESS_LEVEL = 1
+# ============================================================
+
+# ============================================================
+# 共享 HTTP 会话（API 请求复用连接和 SSLContext）
+# ============================================================
+# 进程内只创建一次不校验证书的 SSLContext（Origin Certificate 是自签名证书）
+_SHARED_UNVERIFIED_CTX = ssl._create_unverified_context()
+
+
+class _UnverifiedHTTPAdapter(HTTPAdapter):
+    """所有连接池（包括代理连接池）共用同一个 SSLContext，避免每次请求重新创建"""
+    
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = _SHARED_UNVERIFIED_CTX
+        return super().init_poolmanager(*args, **kwargs)
+    
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs["ssl_context"] = _SHARED_UNVERIFIED_CTX
+        return super().proxy_manager_for(proxy, **proxy_kwargs)
+
+
+# API 请求和图片下载共用，保持 keep-alive 连接，避免每张图片都重新进行 TCP/TLS 握手
+# 批量并发时每个主机最多保留 32 个连接；重试由调用方控制，适配器本身不重试
+_SESSION = requests.Session()
+# 注意：设置了 REQUESTS_CA_BUNDLE / CURL_CA_BUNDLE 环境变量时，requests 会用其覆盖 session.verify，
+# 因此每次请求仍需显式传入 verify=False（Origin Certificate 是自签名证书）
+_SESSION.verify = False
+_SESSION.mount("https://", _UnverifiedHTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0))
+_SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0))
+_SESSION.headers["User-Agent"] = f"Comfyui_o1key {requests.utils.default_user_agent()}"
+# ============================================================
+
+
+class _CircuitBreaker:
+    """
+    上游接口熔断器（线程安全，所有节点共享）
+    
+    连续 threshold 次 5xx / 连接失败后熔断，cooldown 秒内的请求直接失败、不再发出；
+    冷却结束后进入半开状态放行请求，成功则恢复，再次失败则立即重新熔断。
+    读取超时不计入失败：生成 4K 图片本身就可能耗时很长，不代表上游不可用。
+    """
+    
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._fails = 0
+        self._opened_at = 0.0
+    
+    def before_request(self):
+        """熔断期间直接抛出异常；冷却结束后切换为半开状态"""
+        with self._lock:
+            if self._state == "open":
+                remaining = self.cooldown - (time.monotonic() - self._opened_at)
+                if remaining > 0:
+                    raise Exception(
+                        f"❌ 上游服务暂时不可用（熔断中）\n"
+                        f"💡 连续多次请求失败，已暂停发送请求，请约 {remaining:.0f} 秒后重试"
+                    )
+                self._state = "half_open"
+    
+    def record_success(self):
+        with self._lock:
+            self._state = "closed"
+            self._fails = 0
+    
+    def record_failure(self):
+        with self._lock:
+            self._fails += 1
+            if self._state == "half_open" or self._fails >= self.threshold:
+                if self._state != "open":
+                    logger.warning("上游连续失败 %d 次，熔断 %.0f 秒", self._fails, self.cooldown)
+                self._state = "open"
+                self._opened_at = time.monotonic()
+
+
+# 按主机分别熔断：某条网络线路故障时，切换到其他线路不受影响
+_CIRCUIT_BREAKERS = {}
+_CIRCUIT_BREAKERS_LOCK = threading.Lock()
+
+
+def _post_with_circuit_breaker(url, **kwargs):
+    """
+    经过熔断器发送 POST 请求（参数与 _SESSION.post 相同）
+    
+    只负责熔断判断和结果记录，不做任何重试（生成接口按次计费）
+    """
+    host = urlsplit(url).netloc
+    breaker = _CIRCUIT_BREAKERS.get(host)
+    if breaker is None:
+        with _CIRCUIT_BREAKERS_LOCK:
+            breaker = _CIRCUIT_BREAKERS.setdefault(host, _CircuitBreaker())
+    
+    breaker.before_request()
+    try:
+        response = _SESSION.post(url, verify=False, **kwargs)  # 禁用 SSL 验证（见 _SESSION 处说明）
+    except requests.exceptions.ConnectionError:
+        # 包括 ConnectTimeout；ReadTimeout 不是 ConnectionError 的子类，不计入失败
+        breaker.record_failure()
+        raise
+    
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
+
+
+# 需要隐藏的敏感词汇和模式（模块加载时预编译，错误路径上不再重复解析/查找正则缓存）
+_SENSITIVE_PATTERNS = tuple((re.compile(pattern), replacement) for pattern, replacement in (
+    # API URL地址
+    (r'https?://[^\s\)]+', '[API地址已隐藏]'),
+    # 平台相关词汇
+    (r'(?i)new\s+api', '[平台信息已隐藏]'),
+    (r'(?i)o1key\.com', '[平台信息已隐藏]'),
+    (r'(?i)aabao\.top', '[平台信息已隐藏]'),
+    (r'(?i)api\.o1key', '[平台信息已隐藏]'),
+    (r'(?i)api\.aabao', '[平台信息已隐藏]'),
+    # 上游接口相关
+    (r'(?i)upstream', '[上游接口信息已隐藏]'),
+    (r'(?i)origin', '[源站信息已隐藏]'),
+    # 其他可能的敏感信息
+    (r'(?i)google\s+ai\s+studio', '[平台信息已隐藏]'),
+    (r'(?i)gemini\s+api', '[平台信息已隐藏]'),
+))
+
 
 def sanitize_error_message(error_text):
     """
@@ -58,33 +282,27 @@ def sanitize_error_message(error_text):
     if not error_text:
         return error_text
     
-    import re
-    
-    # 需要隐藏的敏感词汇和模式
-    sensitive_patterns = [
-        # API URL地址
-        (r'https?://[^\s\)]+', '[API地址已隐藏]'),
-        # 平台相关词汇
-        (r'(?i)new\s+api', '[平台信息已隐藏]'),
-        (r'(?i)o1key\.com', '[平台信息已隐藏]'),
-        (r'(?i)aabao\.top', '[平台信息已隐藏]'),
-        (r'(?i)api\.o1key', '[平台信息已隐藏]'),
-        (r'(?i)api\.aabao', '[平台信息已隐藏]'),
-        # 上游接口相关
-        (r'(?i)upstream', '[上游接口信息已隐藏]'),
-        (r'(?i)origin', '[源站信息已隐藏]'),
-        # 其他可能的敏感信息
-        (r'(?i)google\s+ai\s+studio', '[平台信息已隐藏]'),
-        (r'(?i)gemini\s+api', '[平台信息已隐藏]'),
-    ]
-    
     sanitized = error_text
-    for pattern, replacement in sensitive_patterns:
-        sanitized = re.sub(pattern, replacement, sanitized)
+    for pattern, replacement in _SENSITIVE_PATTERNS:
+        sanitized = pattern.sub(replacement, sanitized)
     
     return sanitized
 
 
+# 常见错误码的友好提示
+_ERROR_MESSAGES = MappingProxyType({
+    500: "服务器内部错误，请稍后重试",
+    502: "网关错误，服务器暂时不可用",
+    503: "服务暂时不可用，可能正在维护中",
+    504: "网关超时，服务器响应时间过长",
+    520: "服务器返回未知错误",
+    521: "服务器已下线",
+    522: "连接超时",
+    523: "源站不可达",
+    524: "发生超时",
+})
+
+
 def parse_api_error(status_code, error_text):
     """
     解析 API 错误，返回用户友好的错误消息
@@ -97,39 +315,22 @@ def parse_api_error(status_code, error_text):
         str: 用户友好的错误消息
     """
     # 检测是否为 HTML 响应（Cloudflare 等网关错误）
-    is_html = error_text.strip().startswith('<!DOCTYPE') or error_text.strip().startswith('<html')
-    
-    # 常见错误码的友好提示
-    error_messages = {
-        500: "服务器内部错误，请稍后重试",
-        502: "网关错误，服务器暂时不可用",
-        503: "服务暂时不可用，可能正在维护中",
-        504: "网关超时，服务器响应时间过长",
-        520: "服务器返回未知错误",
-        521: "服务器已下线",
-        522: "连接超时",
-        523: "源站不可达",
-        524: "发生超时",
-    }
-    
-    # 清理敏感信息
-    sanitized_error = sanitize_error_message(error_text)
+    # HTML 错误页不展示原文，无需清理敏感信息
+    is_html = error_text.lstrip().startswith(('<!DOCTYPE', '<html'))
+    base_msg = _ERROR_MESSAGES.get(status_code)
     
-    if status_code in error_messages:
-        base_msg = error_messages[status_code]
-        if is_html:
+    if is_html:
+        if base_msg:
             return f"⚠️ {base_msg} (错误码: {status_code})"
-        else:
-            # 如果不是 HTML，可以显示部分错误信息（已清理敏感信息）
-            short_error = sanitized_error[:100] if len(sanitized_error) > 100 else sanitized_error
-            return f"⚠️ {base_msg}\n   详情: {short_error}"
+        return f"⚠️ 服务器错误 (错误码: {status_code})"
+    
+    # 非 HTML 时可以显示部分错误信息（已清理敏感信息；切片超出长度是安全的）
+    sanitized_error = sanitize_error_message(error_text)
+    if base_msg:
+        return f"⚠️ {base_msg}\n   详情: {sanitized_error[:100]}"
     
     # 其他错误
-    if is_html:
-        return f"⚠️ 服务器错误 (错误码: {status_code})"
-    else:
-        short_error = sanitized_error[:200] if len(sanitized_error) > 200 else sanitized_error
-        return f"⚠️ API 错误 (状态码 {status_code}): {short_error}"
+    return f"⚠️ API 错误 (状态码 {status_code}): {sanitized_error[:200]}"
 
 
 def format_json_for_display(data, max_base64_length=100):
@@ -155,9 +356,13 @@ def format_json_for_display(data, max_base64_length=100):
                     # 处理 inline_data 对象
                     if isinstance(value, dict) and 'data' in value:
                         if isinstance(value['data'], str) and len(value['data']) > max_base64_length:
-                            value_copy = value.copy()
-                            value_copy['data'] = value['data'][:max_base64_length] + f"... [已截断，总长度: {len(value['data'])} 字符]"
-                            result[key] = value_copy
+                            # Gemini 的 inline_data 只包含 mime 类型和 data 两个字段，直接构建新字典
+                            # mime 键的写法与外层键无关（两种写法都可能出现），按实际存在的键读取
+                            mime_key = 'mime_type' if 'mime_type' in value else 'mimeType'
+                            result[key] = {
+                                mime_key: value.get(mime_key),
+                                'data': value['data'][:max_base64_length] + f"... [已截断，总长度: {len(value['data'])} 字符]",
+                            }
                         else:
                             result[key] = truncate_base64(value)
                     else:
@@ -183,9 +388,10 @@ def format_json_for_display(data, max_base64_length=100):
 
 
 # Model name mapping: UI name -> Official API name
-MODEL_NAME_MAPPING = {
+# 以下模块级常量均为只读：映射使用 MappingProxyType，模型集合使用 frozenset（O(1) 成员判断）
+MODEL_NAME_MAPPING = MappingProxyType({
     "gemini-3-pro-image-preview-url": "gemini-3-pro-image-preview-url"
-}
+})
 
 # 当前支持的模型（固定为单一模型）
 CURRENT_MODEL = "gemini-3-pro-image-preview-url"
@@ -195,19 +401,19 @@ CURRENT_MODEL = "gemini-3-pro-image-preview-url"
 
 # Gemini 模型分类
 # URL 格式模型：返回图片 URL，需要额外下载
-GEMINI_URL_MODELS = [
+GEMINI_URL_MODELS = frozenset({
     "gemini-3-pro-image-preview-url",
-    # 注意：带清晰度后缀的模型会动态生成，不需要在此列表中
-]
+    # 注意：带清晰度后缀的模型会动态生成，不需要在此集合中
+})
 
 # Base64 格式模型：直接返回 base64 编码的图片数据
-GEMINI_B64_MODELS = [
+GEMINI_B64_MODELS = frozenset({
     # 如果有返回 base64 的模型，在此添加
-]
+})
 
 # 宽高比 -> 1K 分辨率映射表 (来自 Gemini 3 Pro Image 官方文档)
 # 用于 OpenAI 格式 API 的 size 参数
-ASPECT_RATIO_TO_1K_SIZE = {
+ASPECT_RATIO_TO_1K_SIZE = MappingProxyType({
     "1:1":  "1024x1024",
     "2:3":  "848x1264",
     "3:2":  "1264x848",
@@ -218,15 +424,41 @@ ASPECT_RATIO_TO_1K_SIZE = {
     "9:16": "768x1376",
     "16:9": "1376x768",
     "21:9": "1584x672",
-}
+})
 
 # image_size -> 模型后缀映射
 # 根据用户选择的清晰度，选择对应的模型版本
-IMAGE_SIZE_TO_MODEL_SUFFIX = {
+IMAGE_SIZE_TO_MODEL_SUFFIX = MappingProxyType({
     "1K": "-1K",
     "2K": "-2K",
     "4K": "-4K",
-}
+})
+
+# image_size -> 实际模型名（预先生成并驻留，避免每次调用拼接字符串）
+# 平台模型命名规则：1K 没有尺寸后缀，2K/4K 在 -url 前插入小写尺寸
+_SIZE_SUFFIXED_MODEL = MappingProxyType({
+    "1K": sys.intern("gemini-3-pro-image-preview-url"),
+    "2K": sys.intern("gemini-3-pro-image-preview-2k-url"),
+    "4K": sys.intern("gemini-3-pro-image-preview-4k-url"),
+})
+
+
+def _normalize_image_size(image_size):
+    """
+    规范化清晰度（去空白、转大写，"2k" 与 "2K" 等价），不支持的值直接报错
+    
+    不能静默降级为 1K 模型：用户会在不知情的情况下得到低分辨率图片
+    
+    Args:
+        image_size (str): 清晰度 (如 "2K")
+        
+    Returns:
+        str: _SIZE_SUFFIXED_MODEL 中的键 ("1K" / "2K" / "4K")
+    """
+    size_key = image_size.strip().upper()
+    if size_key not in _SIZE_SUFFIXED_MODEL:
+        raise ValueError(f"不支持的清晰度: {image_size}（可选: {', '.join(_SIZE_SUFFIXED_MODEL)}）")
+    return size_key
 
 
 def get_official_model_name(display_name):
@@ -278,16 +510,8 @@ def get_openai_model_and_size(model, aspect_ratio, image_size):
     # 获取 1K 分辨率尺寸
     size = ASPECT_RATIO_TO_1K_SIZE.get(aspect_ratio, "1024x1024")
     
-    # 根据 image_size 动态生成模型名
-    base_model = "gemini-3-pro-image-preview"
-    
-    if image_size == "1K" or image_size is None:
-        # 1K 是默认的
-        actual_model = f"{base_model}-url"
-    else:
-        # 2K 或 4K，在 -url 前插入尺寸
-        size_lower = image_size.lower()  # 2K -> 2k, 4K -> 4k
-        actual_model = f"{base_model}-{size_lower}-url"
+    # 根据 image_size 选择模型名（未指定时默认 1K；"2k" 等小写写法按大写处理）
+    actual_model = _SIZE_SUFFIXED_MODEL[_normalize_image_size(image_size) if image_size else "1K"]
     
     return actual_model, size
 
@@ -329,11 +553,11 @@ def call_openai_format_api(
     # 根据是否有参考图选择接口
     if reference_images_base64 and len(reference_images_base64) > 0:
         # 图生图：使用 /v1/images/edits (multipart/form-data)
-        endpoint = f"{base_url}/v1/images/edits"
+        endpoint = base_url + _PATH_IMAGES_EDITS
         return _call_openai_image_edit(endpoint, prompt, model, size, api_key, reference_images_base64, response_format, proxy)
     else:
         # 文生图：使用 /v1/images/generations (JSON)
-        endpoint = f"{base_url}/v1/images/generations"
+        endpoint = base_url + _PATH_IMAGES_GENERATIONS
         return _call_openai_image_generation(endpoint, prompt, model, size, api_key, response_format, proxy)
 
 
@@ -358,7 +582,10 @@ def _call_openai_image_generation(endpoint, prompt, model, size, api_key, respon
         "response_format": response_format,
     }
     
-    logger.debug(f"发送图片生成请求")
+    # 请求体在发送计时之前序列化
+    body_bytes = _json_dumps(body)
+    
+    logger.debug("发送图片生成请求")
     
     # 构建代理配置
     user_proxy = proxy.strip() if proxy else None
@@ -373,82 +600,21 @@ def _call_openai_image_generation(endpoint, prompt, model, size, api_key, respon
         connect_timeout = 60
         read_timeout = 600
     
-    # 简化日志输出
-    print(f"\n⏱️ 发送请求...", flush=True)
-    if active_proxy:
-        print(f"    🔀 代理: 已启用", flush=True)
-    else:
-        print(f"    🔀 代理: 未启用（直连）", flush=True)
+    # 简化日志输出：发送前只输出一行，各阶段耗时在结束时汇总输出
+    print(f"\n⏱️ 发送请求... (代理: {'已启用' if active_proxy else '未启用（直连）'})", flush=True)
     
-    _t_request = time.time()
+    _t_request = time.monotonic_ns()
     try:
-        response = requests.post(
+        response = _post_with_circuit_breaker(
             endpoint,
             headers=headers,
-            json=body,
+            data=body_bytes,  # 请求头中已声明 Content-Type: application/json
             timeout=(connect_timeout, read_timeout),
-            verify=False,  # 禁用 SSL 验证（Origin Certificate 是自签名证书）
             proxies=proxies_dict
         )
-        _t_connect = time.time() - _t_request
-        
-        # 确认代理使用情况并显示连接建立
-        if active_proxy:
-            via_header = response.headers.get('Via', '')
-            if via_header:
-                print(f"    ✅ 代理已生效, 连接建立: {_t_connect:.2f}s", flush=True)
-            else:
-                print(f"    ✅ 代理已应用, 连接建立: {_t_connect:.2f}s", flush=True)
-        else:
-            print(f"    ✅ 连接建立: {_t_connect:.2f}s", flush=True)
-        
-        if response.status_code == 200:
-            try:
-                _t_response = time.time()
-                response_json = response.json()
-                _t_parse = time.time() - _t_response
-                
-                # 只显示总耗时
-                total_time = _t_connect + _t_parse
-                print(f"    ⏱️  总耗时: {total_time:.3f}s", flush=True)
-                
-                return _parse_openai_response(response_json)
-            except json.JSONDecodeError:
-                logger.warning("响应不是有效的 JSON 格式")
-                raise Exception("API 返回了非 JSON 格式的响应")
-        else:
-            error_text = response.text
-            friendly_error = parse_api_error(response.status_code, error_text)
-            logger.error(f"请求错误 (状态码 {response.status_code})")
-            
-            # 检测模型未配置的错误
-            if "model_not_found" in error_text or "无可用渠道" in error_text:
-                friendly_msg = (
-                    f"❌ 模型暂时不可用\n\n"
-                    f"当前所选模型暂时无法使用，可能正在维护中。\n\n"
-                    f"💡 解决方法：\n"
-                    f"   • 请稍后重试\n"
-                    f"   • 或联系技术支持获取帮助"
-                )
-                raise Exception(friendly_msg)
-            
-            # 客户端错误 (4xx)
-            if response.status_code == 401:
-                raise Exception("❌ API 密钥无效或已过期")
-            elif response.status_code == 429:
-                raise Exception("❌ 请求过于频繁，请稍后再试")
-            elif response.status_code == 504:
-                raise Exception(
-                    f"❌ {friendly_error}\n\n"
-                    f"💡 提示：\n"
-                    f"   • 504 超时可能是因为 4K 图片生成时间较长\n"
-                    f"   • 请求可能已在服务端处理中，请稍后检查是否已扣费\n"
-                    f"   • 建议先用 2K 测试效果，再生成 4K\n"
-                    f"   • 如需重试，请手动重新运行"
-                )
-            else:
-                raise Exception(f"❌ {friendly_error}\n💡 建议稍后手动重试或降低图片清晰度")
-                
+        _t_connect = time.monotonic_ns() - _t_request
+        return _handle_openai_response(response, _t_connect, active_proxy)
+    
     except requests.exceptions.Timeout:
         raise Exception(
             "❌ 请求超时\n\n"
@@ -477,13 +643,6 @@ def _call_openai_image_edit(endpoint, prompt, model, size, api_key, images_base6
         "Authorization": f"Bearer {api_key}",
     }
     
-    # 构建多图上传的 files 列表
-    # multipart/form-data 支持同名字段传递多个文件
-    files = []
-    for idx, img_base64 in enumerate(images_base64):
-        image_bytes = base64.b64decode(img_base64)
-        files.append(("image", (f"image_{idx}.png", image_bytes, "image/png")))
-    
     data = {
         "model": model,
         "prompt": prompt,
@@ -491,7 +650,33 @@ def _call_openai_image_edit(endpoint, prompt, model, size, api_key, images_base6
         "response_format": response_format,
     }
     
-    logger.debug(f"发送图生图请求，参考图数量: {len(images_base64)}")
+    # 构建多图上传的 multipart/form-data 请求体
+    # multipart/form-data 支持同名字段传递多个文件
+    if MultipartEncoder is not None:
+        # 流式上传：每张参考图在发送时按块解码，不需要同时在内存中保留全部解码后的图片
+        # （此路径不使用参考图缓存：缓存需要完整解码结果，且对大图计算摘要本身就有开销）
+        fields = list(data.items())
+        for idx, img_base64 in enumerate(images_base64):
+            mime_type, ext = _sniff_base64_image_type(img_base64)
+            fields.append(("image", (f"image_{idx}.{ext}", _Base64Stream(img_base64), mime_type)))
+        encoder = MultipartEncoder(fields=fields)
+        headers["Content-Type"] = encoder.content_type
+        post_kwargs = {"data": encoder}
+    else:
+        # 多张参考图时并发解码（base64 解码在 C 实现中释放 GIL）；
+        # 同一张参考图在多次调用间复用解码结果
+        if len(images_base64) > 1:
+            with ThreadPoolExecutor(max_workers=min(8, len(images_base64))) as executor:
+                decoded_images = list(executor.map(_decode_reference_image, images_base64))
+        else:
+            decoded_images = [_decode_reference_image(img_base64) for img_base64 in images_base64]
+        files = []
+        for idx, (img_base64, image_bytes) in enumerate(zip(images_base64, decoded_images)):
+            mime_type, ext = _sniff_base64_image_type(img_base64)
+            files.append(("image", (f"image_{idx}.{ext}", image_bytes, mime_type)))
+        post_kwargs = {"files": files, "data": data}
+    
+    logger.debug("发送图生图请求，参考图数量: %d", len(images_base64))
     
     # 构建代理配置
     user_proxy = proxy.strip() if proxy else None
@@ -506,83 +691,21 @@ def _call_openai_image_edit(endpoint, prompt, model, size, api_key, images_base6
         connect_timeout = 60
         read_timeout = 600
     
-    # 简化日志输出
-    print(f"\n⏱️ 发送请求...", flush=True)
-    if active_proxy:
-        print(f"    🔀 代理: 已启用", flush=True)
-    else:
-        print(f"    🔀 代理: 未启用（直连）", flush=True)
+    # 简化日志输出：发送前只输出一行，各阶段耗时在结束时汇总输出
+    print(f"\n⏱️ 发送请求... (代理: {'已启用' if active_proxy else '未启用（直连）'})", flush=True)
     
-    _t_request = time.time()
+    _t_request = time.monotonic_ns()
     try:
-        response = requests.post(
+        response = _post_with_circuit_breaker(
             endpoint,
             headers=headers,
-            files=files,
-            data=data,
             timeout=(connect_timeout, read_timeout),
-            verify=False,  # 禁用 SSL 验证（Origin Certificate 是自签名证书）
-            proxies=proxies_dict
+            proxies=proxies_dict,
+            **post_kwargs
         )
-        _t_connect = time.time() - _t_request
-        
-        # 确认代理使用情况并显示连接建立
-        if active_proxy:
-            via_header = response.headers.get('Via', '')
-            if via_header:
-                print(f"    ✅ 代理已生效, 连接建立: {_t_connect:.2f}s", flush=True)
-            else:
-                print(f"    ✅ 代理已应用, 连接建立: {_t_connect:.2f}s", flush=True)
-        else:
-            print(f"    ✅ 连接建立: {_t_connect:.2f}s", flush=True)
-        
-        if response.status_code == 200:
-            try:
-                _t_response = time.time()
-                response_json = response.json()
-                _t_parse = time.time() - _t_response
-                
-                # 只显示总耗时
-                total_time = _t_connect + _t_parse
-                print(f"    ⏱️  总耗时: {total_time:.3f}s", flush=True)
-                
-                return _parse_openai_response(response_json)
-            except json.JSONDecodeError:
-                logger.warning("响应不是有效的 JSON 格式")
-                raise Exception("API 返回了非 JSON 格式的响应")
-        else:
-            error_text = response.text
-            friendly_error = parse_api_error(response.status_code, error_text)
-            logger.error(f"请求错误 (状态码 {response.status_code})")
-            
-            # 检测模型未配置的错误
-            if "model_not_found" in error_text or "无可用渠道" in error_text:
-                friendly_msg = (
-                    f"❌ 模型暂时不可用\n\n"
-                    f"当前所选模型暂时无法使用，可能正在维护中。\n\n"
-                    f"💡 解决方法：\n"
-                    f"   • 请稍后重试\n"
-                    f"   • 或联系技术支持获取帮助"
-                )
-                raise Exception(friendly_msg)
-            
-            # 客户端错误 (4xx)
-            if response.status_code == 401:
-                raise Exception("❌ API 密钥无效或已过期")
-            elif response.status_code == 429:
-                raise Exception("❌ 请求过于频繁，请稍后再试")
-            elif response.status_code == 504:
-                raise Exception(
-                    f"❌ {friendly_error}\n\n"
-                    f"💡 提示：\n"
-                    f"   • 504 超时可能是因为 4K 图片生成时间较长\n"
-                    f"   • 请求可能已在服务端处理中，请稍后检查是否已扣费\n"
-                    f"   • 建议先用 2K 测试效果，再生成 4K\n"
-                    f"   • 如需重试，请手动重新运行"
-                )
-            else:
-                raise Exception(f"❌ {friendly_error}\n💡 建议稍后手动重试或降低图片清晰度")
-                
+        _t_connect = time.monotonic_ns() - _t_request
+        return _handle_openai_response(response, _t_connect, active_proxy)
+    
     except requests.exceptions.Timeout:
         raise Exception(
             "❌ 请求超时\n\n"
@@ -597,34 +720,210 @@ def _call_openai_image_edit(endpoint, prompt, model, size, api_key, images_base6
         raise Exception(f"❌ 网络连接失败\n💡 请检查网络连接后重试")
 
 
+class _Base64Stream:
+    """
+    按需解码 base64 字符串的只读文件对象，供 MultipartEncoder 流式上传使用
+    
+    每次 read() 只解码所需的部分，解码后的完整图片不会常驻内存。
+    要求输入为标准 base64（长度为 4 的倍数，不含 data URI 前缀）。
+    """
+    # 每次解码的 base64 字符数（必须是 4 的倍数）
+    _CHUNK_CHARS = 64 * 1024
+    
+    def __init__(self, base64_string):
+        self._b64 = base64_string
+        self._offset = 0
+        self._buffer = b""
+        self._position = 0
+        padding = 2 if base64_string.endswith("==") else 1 if base64_string.endswith("=") else 0
+        self._length = len(base64_string) // 4 * 3 - padding
+    
+    def __len__(self):
+        # requests_toolbelt 把 len() 视为剩余未读字节数，并循环读取直到其为 0，
+        # 因此必须返回剩余长度而不是总长度，否则读完后会无限循环
+        return self._length - self._position
+    
+    def tell(self):
+        return self._position
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length - self._position
+        while len(self._buffer) < size and self._offset < len(self._b64):
+            end = self._offset + self._CHUNK_CHARS
+            self._buffer += _b64.b64decode(self._b64[self._offset:end])
+            self._offset = end
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._position += len(chunk)
+        return chunk
+
+
+# 参考图解码缓存：批量处理时同一张参考图会随每次请求重复上传
+# 以 base64 内容的 blake2b 摘要为键（不在缓存中保留巨大的 base64 字符串），按总字节数淘汰最久未用的条目
+_REF_CACHE_MAX_BYTES = 128 * 1024 * 1024
+_REF_CACHE = OrderedDict()
+_REF_CACHE_BYTES = 0
+_REF_CACHE_LOCK = threading.Lock()
+
+
+def _reference_cache_key(image_base64):
+    return hashlib.blake2b(image_base64.encode('ascii'), digest_size=16).digest()
+
+
+def _decode_reference_image(image_base64):
+    """
+    解码参考图 base64，结果按内容缓存
+    
+    Args:
+        image_base64 (str): 参考图的 base64 数据
+        
+    Returns:
+        bytes: 解码后的图片文件数据
+    """
+    global _REF_CACHE_BYTES
+    key = _reference_cache_key(image_base64)
+    with _REF_CACHE_LOCK:
+        image_bytes = _REF_CACHE.get(key)
+        if image_bytes is not None:
+            _REF_CACHE.move_to_end(key)
+            return image_bytes
+    
+    # 解码在锁外进行，多张参考图可以并发解码
+    image_bytes = _b64.b64decode(image_base64)
+    if len(image_bytes) > _REF_CACHE_MAX_BYTES:
+        return image_bytes
+    
+    with _REF_CACHE_LOCK:
+        if key not in _REF_CACHE:
+            _REF_CACHE[key] = image_bytes
+            _REF_CACHE_BYTES += len(image_bytes)
+            while _REF_CACHE_BYTES > _REF_CACHE_MAX_BYTES:
+                _, evicted = _REF_CACHE.popitem(last=False)
+                _REF_CACHE_BYTES -= len(evicted)
+    return image_bytes
+
+
+def _log_proxy_status(response, active_proxy):
+    """调试模式下输出代理生效情况（非调试模式直接跳过，不做任何格式化）"""
+    if active_proxy and logger.isEnabledFor(logging.DEBUG):
+        if response.headers.get('Via', ''):
+            logger.debug("代理已生效")
+        else:
+            logger.debug("代理已应用")
+
+
+def _print_timings(timings):
+    """
+    将各阶段耗时汇总为一行输出
+    
+    Args:
+        timings (dict): 阶段名 -> 耗时（纳秒，time.monotonic_ns 差值），按插入顺序输出
+    """
+    total_time = sum(timings.values()) / 1e9
+    detail = ", ".join(f"{name}: {ns / 1e9:.2f}s" for name, ns in timings.items())
+    print(f"    ✅ {detail} | 总耗时: {total_time:.3f}s", flush=True)
+
+
+def _handle_http_error(response):
+    """
+    处理非 200 响应（Gemini / OpenAI 格式接口共用），转换为用户友好的错误并抛出
+    
+    生成接口按次计费，此处只报告错误、不返回重试等待时间；需要重试时由用户手动重新运行，
+    避免 504 等超时后服务端其实仍在处理而导致重复扣费。
+    
+    Args:
+        response (requests.Response): 状态码非 200 的接口响应
+        
+    Raises:
+        Exception: 始终抛出，消息已清理敏感信息
+    """
+    status_code = response.status_code
+    error_text = response.text
+    friendly_error = parse_api_error(status_code, error_text)
+    logger.error(f"请求错误 (状态码 {status_code})")
+    
+    # 检测模型未配置的错误
+    if "model_not_found" in error_text or "无可用渠道" in error_text:
+        friendly_msg = (
+            f"❌ 模型暂时不可用\n\n"
+            f"当前所选模型暂时无法使用，可能正在维护中。\n\n"
+            f"💡 解决方法：\n"
+            f"   • 请稍后重试\n"
+            f"   • 或联系技术支持获取帮助"
+        )
+        raise Exception(friendly_msg)
+    
+    # 客户端错误 (4xx)
+    if status_code == 401:
+        raise Exception("❌ API密钥无效或已过期，请检查您的密钥配置")
+    elif status_code == 429:
+        raise Exception("❌ 请求过于频繁，请稍后再试")
+    elif status_code == 504:
+        raise Exception(
+            f"❌ {friendly_error}\n\n"
+            f"💡 提示：\n"
+            f"   • 504 超时可能是因为 4K 图片生成时间较长\n"
+            f"   • 请求可能已在服务端处理中，请稍后检查是否已扣费\n"
+            f"   • 建议先用 2K 测试效果，再生成 4K\n"
+            f"   • 如需重试，请手动重新运行"
+        )
+    else:
+        raise Exception(f"❌ {friendly_error}\n💡 建议稍后手动重试或降低图片清晰度")
+
+
+def _handle_openai_response(response, t_connect, active_proxy):
+    """
+    处理 OpenAI 格式接口的 HTTP 响应（生成/编辑接口共用）
+    
+    Args:
+        response (requests.Response): 接口响应
+        t_connect (int): 请求发出到收到响应头的耗时（纳秒）
+        active_proxy (str): 当前生效的代理地址，未使用代理时为 None
+        
+    Returns:
+        PIL.Image: 生成的图片
+    """
+    timings = {"连接": t_connect}
+    _log_proxy_status(response, active_proxy)
+    
+    if response.status_code == 200:
+        try:
+            _t_response = time.monotonic_ns()
+            response_json = _json_loads(response.content)
+            timings["解析"] = time.monotonic_ns() - _t_response
+        except json.JSONDecodeError:
+            logger.warning("响应不是有效的 JSON 格式")
+            raise Exception("API 返回了非 JSON 格式的响应")
+        
+        _t_extract = time.monotonic_ns()
+        result = _parse_openai_response(response_json)
+        timings["提取"] = time.monotonic_ns() - _t_extract
+        _print_timings(timings)
+        return result
+    else:
+        _handle_http_error(response)
+
+
 def _parse_openai_response(response_json):
     """
     解析 OpenAI 格式 API 的响应，返回 PIL.Image
     """
     try:
-        _t_parse = time.time()
-        
-        if "data" not in response_json or len(response_json["data"]) == 0:
+        data = response_json.get("data")
+        if not data:
             raise Exception(f"响应中没有图片数据: {list(response_json.keys())}")
         
-        image_data = response_json["data"][0]
+        image_data = data[0]
         
-        if "b64_json" in image_data:
-            base64_str = image_data["b64_json"]
-            print(f"\n⏱️ 正在提取图片数据...", flush=True)
-            result = decode_base64_image(base64_str)
-            print(f"    ✅ 提取完成: 耗时 {time.time()-_t_parse:.2f}s", flush=True)
-            return result
+        b64 = image_data.get("b64_json")
+        if b64 is not None:
+            return decode_base64_image(b64)
         
-        if "url" in image_data:
-            url = image_data["url"]
-            print(f"\n⏱️ 正在提取图片数据...", flush=True)
-            result = download_image_from_url(url)
-            print(f"    ✅ 提取完成: 耗时 {time.time()-_t_parse:.2f}s", flush=True)
-            return result
+        url = image_data.get("url")
+        if url:
+            return download_image_from_url(url)
         
-        available_keys = list(image_data.keys())
-        raise Exception(f"无法解析图片数据，可用字段: {available_keys}")
+        raise Exception(f"无法解析图片数据，可用字段: {list(image_data.keys())}")
         
     except Exception as e:
         sanitized_error = sanitize_error_message(str(e))
@@ -632,6 +931,14 @@ def _parse_openai_response(response_json):
         raise
 
 
+@functools.lru_cache(maxsize=32)
+def _gemini_endpoint(base_url, official_model):
+    """
+    拼接 Gemini 格式的生成接口地址（线路 × 模型的组合很少，结果缓存复用）
+    """
+    return base_url + _PATH_GEMINI_GENERATE_FMT.format(official_model)
+
+
 def call_nano_banana_api(
     prompt,
     model="nano-banana-pro-svip",
@@ -671,10 +978,10 @@ def call_nano_banana_api(
     if is_openai_format_model(model, network_url):
         # 使用 OpenAI 格式 API
         actual_model, size = get_openai_model_and_size(model, aspect_ratio, image_size or "1K")
-        logger.debug(f"Using OpenAI format: model={actual_model}, size={size}, response_format={response_format}")
+        logger.debug("Using OpenAI format: model=%s, size=%s, response_format=%s", actual_model, size, response_format)
         
-        # 直接返回 PIL.Image（与 Gemini 格式的返回值不同）
-        pil_image = call_openai_format_api(
+        # 直接返回 PIL.Image（与 Gemini 格式的返回值不同，process_api_response 按类型区分）
+        return call_openai_format_api(
             prompt=prompt,
             model=actual_model,
             size=size,
@@ -684,10 +991,6 @@ def call_nano_banana_api(
             network_url=network_url,  # 传递网络线路URL
             proxy=proxy  # 传递代理设置
         )
-        
-        # 包装成与 Gemini 格式兼容的响应结构
-        # 这样 process_api_response 可以统一处理
-        return {"_openai_pil_image": pil_image}
     
     # ========== 原有逻辑：Gemini 格式 API ==========
     # 检查模型是否在GEMINI列表中（使用原始模型名，包含A-前缀）
@@ -697,7 +1000,7 @@ def call_nano_banana_api(
         # 这些模型默认返回 b64_json，如果用户选择了 url，我们仍然使用 b64_json
         # 因为 Gemini 格式 API 的响应格式是由 API 本身决定的
         response_format = "b64_json"
-        logger.debug(f"Model {model} is in GEMINI_B64_MODELS, using b64_json format")
+        logger.debug("Model %s is in GEMINI_B64_MODELS, using b64_json format", model)
     
     # 检查是否为 Gemini URL 系列模型（已包含尺寸信息的模型）
     # 注意：使用原始模型名（包含A-前缀）进行检查
@@ -716,19 +1019,19 @@ def call_nano_banana_api(
     # 注意：如果模型已在 GEMINI_URL_MODELS 中（已包含尺寸后缀），则跳过动态添加
     # 注意：这里使用official_model（已去掉A-前缀）进行处理
     if official_model.endswith("-url") and image_size and not is_gemini_url_model:
-        if image_size in ["2K", "4K"]:
+        size_key = _normalize_image_size(image_size)  # 与 OpenAI 格式一致："2k" 视为 2K，未知值报错
+        if size_key != "1K":
             base_model = official_model[:-4]  # 去掉 "-url"
-            size_lower = image_size.lower()  # 2K -> 2k, 4K -> 4k
-            official_model = f"{base_model}-{size_lower}-url"
+            official_model = f"{base_model}-{size_key.lower()}-url"  # 2K -> 2k, 4K -> 4k
         # 1K 时保持原名 gemini-3-pro-image-preview-url
     
-    logger.debug(f"Model mapping: {model} -> {official_model}")
+    logger.debug("Model mapping: %s -> %s", model, official_model)
     
     # 使用配置节点传入的network_url，如果没有则使用全局配置
     active_base_url = network_url if network_url else API_BASE_URL
     
     # Build the API endpoint
-    base_url = f"{active_base_url}/v1beta/models/{official_model}:generateContent"
+    base_url = _gemini_endpoint(active_base_url, official_model)
     
     headers = {
         "Authorization": f"Bearer {api_key}",
@@ -747,7 +1050,7 @@ def call_nano_banana_api(
         for ref_base64 in reference_images_base64:
             parts.append({
                 "inline_data": {
-                    "mime_type": "image/png",
+                    "mime_type": _sniff_base64_image_type(ref_base64)[0],
                     "data": ref_base64
                 }
             })
@@ -767,9 +1070,12 @@ def call_nano_banana_api(
         "imageConfig": image_config
     }
     
-    # 对于 Gemini URL 系列模型，需要添加 responseModalities 配置
+    content = {"parts": parts}
+    
+    # 对于 Gemini URL 系列模型，需要添加 role 字段和 responseModalities 配置
     # 只要求输出图片，不输出文本
     if is_gemini_url_model:
+        content["role"] = "user"
         generation_config["responseModalities"] = ["IMAGE"]
     
     # Add seed if provided
@@ -778,48 +1084,40 @@ def call_nano_banana_api(
     #     generation_config["seed"] = seed
     
     # Complete request body
-    # 对于 Gemini URL 系列模型，需要添加 role 字段
-    if is_gemini_url_model:
-        body = {
-            "contents": [{
-                "role": "user",
-                "parts": parts
-            }],
-            "generationConfig": generation_config
-        }
-    else:
-        body = {
-            "contents": [{
-                "parts": parts
-            }],
-            "generationConfig": generation_config
-        }
+    body = {
+        "contents": [content],
+        "generationConfig": generation_config
+    }
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Request body structure: %s", list(body.keys()))
+    logger.debug("imageConfig: %s", image_config)
     
-    logger.debug(f"Request body structure: {list(body.keys())}")
-    logger.debug(f"imageConfig: {image_config}")
+    # 请求体只序列化一次，并在发送计时之前完成：
+    # 图生图时请求体包含全部参考图的 base64（单张可达十几 MB），序列化耗时单独统计
+    _t_serialize = time.monotonic_ns()
+    body_bytes = _json_dumps(body)
+    serialize_ns = time.monotonic_ns() - _t_serialize
     
     # 单次请求，不自动重试（避免 504 等超时错误导致重复扣费）
     try:
         # 调试日志
-        mode = "图生图" if reference_images_base64 else "文生图"
-        num_refs = len(reference_images_base64) if reference_images_base64 else 0
-        logger.debug(f"正在生成图片... ({mode}, 参考图{num_refs}张)")
-        logger.debug(f"Model: {model}, Aspect: {aspect_ratio}, Size: {image_size}, Seed: {seed}")
-        logger.debug(f"Prompt: {prompt[:100]}...")
+        if logger.isEnabledFor(logging.DEBUG):
+            mode = "图生图" if reference_images_base64 else "文生图"
+            num_refs = len(reference_images_base64) if reference_images_base64 else 0
+            logger.debug("正在生成图片... (%s, 参考图%d张)", mode, num_refs)
+            logger.debug("Model: %s, Aspect: %s, Size: %s, Seed: %s", model, aspect_ratio, image_size, seed)
+            logger.debug("Prompt: %s...", prompt[:100])
         
         # 构建代理配置：优先使用用户传入的 proxy，其次使用全局配置
         user_proxy = proxy.strip() if proxy else None
         active_proxy = user_proxy or PROXY_URL
         proxies_dict = {"http": active_proxy, "https": active_proxy} if active_proxy else None
         
-        # 简化日志输出
-        print(f"\n⏱️ 发送请求...", flush=True)
-        if active_proxy:
-            print(f"    🔀 代理: 已启用", flush=True)
-        else:
-            print(f"    🔀 代理: 未启用（直连）", flush=True)
+        # 简化日志输出：发送前只输出一行，各阶段耗时在结束时汇总输出
+        print(f"\n⏱️ 发送请求... (代理: {'已启用' if active_proxy else '未启用（直连）'})", flush=True)
         
-        _t_request = time.time()
+        _t_request = time.monotonic_ns()
         
         # 统一采用一次性读取，不使用流式读取
         is_b64_response = is_gemini_b64_model
@@ -836,82 +1134,38 @@ def call_nano_banana_api(
             connect_timeout = 60
             read_timeout = 600
         
-        response = requests.post(
+        response = _post_with_circuit_breaker(
             base_url,
             headers=headers,
-            json=body,
+            data=body_bytes,  # 请求头中已声明 Content-Type: application/json
             timeout=(connect_timeout, read_timeout),
-            verify=False,
             stream=use_stream,  # 统一禁用流式读取
             proxies=proxies_dict
         )
-        _t_connect = time.time() - _t_request
-        
-        # 确认代理使用情况并显示连接建立
-        if active_proxy:
-            via_header = response.headers.get('Via', '')
-            if via_header:
-                print(f"    ✅ 代理已生效, 连接建立: {_t_connect:.2f}s", flush=True)
-            else:
-                print(f"    ✅ 代理已应用, 连接建立: {_t_connect:.2f}s", flush=True)
-        else:
-            print(f"    ✅ 连接建立: {_t_connect:.2f}s", flush=True)
+        timings = {"序列化": serialize_ns, "连接": time.monotonic_ns() - _t_request}
+        _log_proxy_status(response, active_proxy)
         
         # Check if request was successful
         if response.status_code == 200:
             try:
-                _t_download = time.time()
+                _t_download = time.monotonic_ns()
                 
                 # 统一采用一次性读取
                 content = response.content  # 一次性读取全部内容
-                _download_time = time.time() - _t_download
+                timings["下载"] = time.monotonic_ns() - _t_download
                 
-                _t_json = time.time()
-                response_json = json.loads(content.decode('utf-8'))
-                _t_json_parse = time.time() - _t_json
-                
-                # 只显示总耗时
-                total_time = _t_connect + _download_time + _t_json_parse
-                print(f"    ⏱️  总耗时: {total_time:.3f}s", flush=True)
+                _t_json = time.monotonic_ns()
+                response_json = _json_loads(content)
+                timings["解析"] = time.monotonic_ns() - _t_json
                 
+                _print_timings(timings)
                 return response_json
             except json.JSONDecodeError as e:
-                logger.warning(f"响应不是有效的 JSON 格式: {str(e)}")
+                logger.warning("响应不是有效的 JSON 格式: %s", e)
                 raise Exception("API 返回了非 JSON 格式的响应")
         else:
-            # 解析错误响应，检测特定错误类型
-            error_text = response.text
-            friendly_error = parse_api_error(response.status_code, error_text)
-            logger.error(f"请求错误: {response.status_code}")
-            
-            # 检测模型未配置的错误
-            if "model_not_found" in error_text or "无可用渠道" in error_text:
-                friendly_msg = (
-                    f"❌ 模型暂时不可用\n\n"
-                    f"当前所选模型暂时无法使用，可能正在维护中。\n\n"
-                    f"💡 解决方法：\n"
-                    f"   • 请稍后重试\n"
-                    f"   • 或联系技术支持获取帮助"
-                )
-                raise Exception(friendly_msg)
+            _handle_http_error(response)
             
-            # 客户端错误 (4xx)
-            if response.status_code == 401:
-                raise Exception("❌ API密钥无效或已过期，请检查您的密钥配置")
-            elif response.status_code == 429:
-                raise Exception("❌ 请求过于频繁，请稍后再试")
-            elif response.status_code == 504:
-                raise Exception(
-                    f"❌ 服务器响应超时\n\n"
-                    f"💡 提示：\n"
-                    f"   • 生成高清图片需要较长时间\n"
-                    f"   • 请求可能已在处理中\n"
-                    f"   • 建议先用 2K 测试，再生成 4K\n"
-                    f"   • 如需重试，请手动重新运行"
-                )
-            else:
-                raise Exception(f"❌ 服务器错误，建议稍后重试或降低图片清晰度")
-                
     except requests.exceptions.Timeout:
         print(f"⏰ 请求超时 (超过10分钟)")
         raise Exception(
@@ -928,7 +1182,68 @@ def call_nano_banana_api(
         raise Exception(f"❌ 网络连接失败\n💡 请检查网络连接后重试")
 
 
-def extract_image_from_gemini_response(response_data, proxy=""):
+async def call_nano_banana_api_async(*args, **kwargs):
+    """
+    call_nano_banana_api 的异步版本，参数与返回值完全相同
+    
+    请求在线程中执行（共用连接池会话），不阻塞事件循环。
+    多个提示词/参考图组合可以通过 asyncio.gather 并发发送：
+    
+        results = await asyncio.gather(
+            *(call_nano_banana_api_async(prompt=p, api_key=key) for p in prompts),
+            return_exceptions=True,
+        )
+    """
+    return await asyncio.to_thread(call_nano_banana_api, *args, **kwargs)
+
+
+async def call_openai_format_api_async(*args, **kwargs):
+    """call_openai_format_api 的异步版本，参数与返回值完全相同（在线程中执行）"""
+    return await asyncio.to_thread(call_openai_format_api, *args, **kwargs)
+
+
+# 从响应文本中提取图片 URL 的正则（模块加载时预编译）
+# 单次扫描同时匹配两种形式，返回文本中最先出现的一个：
+#   md    - Markdown 图片格式: ![image](URL)
+#   plain - 普通图片链接（以图片扩展名结尾）
+_IMG_ANY_RE = re.compile(
+    r'!\[[^\]]*\]\((?P<md>https?://[^\)]+)\)'
+    r'|(?P<plain>https?://[^\s\)]+\.(?:png|jpg|jpeg|webp|gif))',
+    re.IGNORECASE
+)
+
+
+def _find_image_urls(text, first_only=True):
+    """
+    从响应文本中查找图片 URL（只查找，不下载）
+    
+    Args:
+        text (str): part 的 text 字段
+        first_only (bool): 只返回第一个 URL
+        
+    Returns:
+        list: 图片 URL 列表（按出现顺序）
+    """
+    if first_only:
+        url_match = _IMG_ANY_RE.search(text)
+        return [url_match.group('md') or url_match.group('plain')] if url_match else []
+    return [m.group('md') or m.group('plain') for m in _IMG_ANY_RE.finditer(text)]
+
+
+def _download_images(urls, proxy=""):
+    """
+    下载多张图片，多于一张时并发下载（总耗时取决于最慢的一张，而不是所有下载之和）
+    
+    Returns:
+        list: PIL.Image 列表，顺序与 urls 一致
+    """
+    if len(urls) == 1:
+        return [download_image_from_url(urls[0], proxy=proxy)]
+    with ThreadPoolExecutor(max_workers=min(8, len(urls))) as executor:
+        return list(executor.map(lambda url: download_image_from_url(url, proxy=proxy), urls))
+
+
+def extract_image_from_gemini_response(response_data, proxy="", return_all=False):
     """
     Extract image data from Gemini API response
     
@@ -964,20 +1279,22 @@ def extract_image_from_gemini_response(response_data, proxy=""):
     Args:
         response_data (dict): Gemini API response
         proxy (str): 可选的代理地址，用于下载图片（仅 URL 格式需要）
+        return_all (bool): 返回响应中的全部图片（多个 URL 并发下载），默认只返回第一张
         
     Returns:
-        PIL.Image: Extracted image
+        PIL.Image: Extracted image（return_all=True 时返回 PIL.Image 列表）
     """
     try:
-        _t_extract = time.time()
-        print(f"\n⏱️ 正在提取图片数据...", flush=True)
+        _t_extract = time.monotonic_ns()
         
         # Navigate the response structure
-        if 'candidates' not in response_data or len(response_data['candidates']) == 0:
+        # 每一层只做一次 get（合并成员判断和取值）
+        candidates = response_data.get('candidates')
+        if not candidates:
             logger.error(f"响应结构异常: 缺少 candidates")
             raise Exception("服务器响应格式异常")
         
-        candidate = response_data['candidates'][0]
+        candidate = candidates[0]
         
         # 检查是否有错误的 finishReason
         finish_reason = candidate.get('finishReason', '')
@@ -1011,10 +1328,11 @@ def extract_image_from_gemini_response(response_data, proxy=""):
             msg = reason_messages.get(finish_reason, f"服务器异常终止: {finish_reason}")
             raise Exception(msg)
         
-        if 'content' not in candidate or 'parts' not in candidate['content']:
+        content = candidate.get('content')
+        parts = content.get('parts') if content else None
+        if parts is None:
             # 检查 content 是否为空对象
-            content = candidate.get('content', {})
-            is_empty_content = (content == {} or content is None)
+            is_empty_content = not content
             
             logger.error(f"响应结构异常: 缺少 content 或 parts")
             
@@ -1027,66 +1345,45 @@ def extract_image_from_gemini_response(response_data, proxy=""):
                 )
             raise Exception("服务器响应格式异常")
         
-        parts = candidate['content']['parts']
+        images = []
+        url_candidates = []
         
-        # Try to find inline_data (official Gemini format) first
-        for part_idx, part in enumerate(parts):
-            if 'inline_data' in part or 'inlineData' in part:
-                inline_data = part.get('inline_data') or part.get('inlineData')
-                
+        # 单次遍历 parts：inline_data（官方 Gemini 格式）直接解码；
+        # text 中的图片 URL 只记录候选，全部 parts 都没有 inline_data 时才下载
+        for part in parts:
+            inline_data = part.get('inline_data') or part.get('inlineData')
+            if inline_data:
                 # 处理两种格式：
                 # 1. 标准格式: {"mime_type": "...", "data": "base64..."}
                 # 2. SVIP格式: 直接是 base64 字符串
                 if isinstance(inline_data, dict):
-                    # 标准 Gemini 格式
                     base64_data = inline_data.get('data')
-                    if base64_data:
-                        _t_decode = time.time()
-                        result = decode_base64_image(base64_data)
-                        _t_decode_time = time.time() - _t_decode
-                        print(f"    ✅ 提取完成: 耗时 {_t_decode_time:.2f}s", flush=True)
-                        return result
                 elif isinstance(inline_data, str):
-                    # SVIP 格式：直接是 base64 字符串
-                    _t_decode = time.time()
-                    result = decode_base64_image(inline_data)
-                    _t_decode_time = time.time() - _t_decode
-                    print(f"    ✅ 提取完成: 耗时 {_t_decode_time:.2f}s", flush=True)
-                    return result
-        
-        # If no inline_data, try to extract URL from text
-        # 注意：URL 格式需要额外下载图片文件，而 base64 格式已在响应中，只需本地解码
-        for part_idx, part in enumerate(parts):
-            if 'text' in part:
-                text = part['text']
-                logger.debug(f"Checking text field for image URL...")
-                
-                # Extract URL from markdown format: ![image](URL)
-                import re
-                markdown_match = re.search(r'!\[.*?\]\((https?://[^\)]+)\)', text)
-                if markdown_match:
-                    url = markdown_match.group(1)
-                    # 显示代理信息（如果使用代理）
-                    user_proxy = proxy.strip() if proxy else None
-                    active_proxy = user_proxy or PROXY_URL
-                    if active_proxy:
-                        print(f"    🔀 代理: 已启用", flush=True)
-                    result = download_image_from_url(url, proxy=proxy)
-                    print(f"    ✅ 提取完成: 耗时 {time.time()-_t_extract:.2f}s", flush=True)
-                    return result
+                    base64_data = inline_data
+                else:
+                    base64_data = None
                 
-                # Try to find plain HTTP URL
-                url_match = re.search(r'(https?://[^\s\)]+\.(?:png|jpg|jpeg|webp|gif))', text, re.IGNORECASE)
-                if url_match:
-                    url = url_match.group(1)
-                    # 显示代理信息（如果使用代理）
-                    user_proxy = proxy.strip() if proxy else None
-                    active_proxy = user_proxy or PROXY_URL
-                    if active_proxy:
-                        print(f"    🔀 代理: 已启用", flush=True)
-                    result = download_image_from_url(url, proxy=proxy)
-                    print(f"    ✅ 提取完成: 耗时 {time.time()-_t_extract:.2f}s", flush=True)
-                    return result
+                if base64_data:
+                    images.append(decode_base64_image(base64_data))
+                    if not return_all:
+                        break
+                continue
+            
+            # 已找到 inline 图片时不再需要 URL；单图模式只需第一个 URL
+            if images or (url_candidates and not return_all):
+                continue
+            text = part.get('text')
+            if text:
+                url_candidates.extend(_find_image_urls(text, first_only=not return_all))
+        
+        # If no inline_data, download the image(s) from the URL(s) found in text
+        # 注意：URL 格式需要额外下载图片文件，而 base64 格式已在响应中，只需本地解码
+        if not images and url_candidates:
+            images = _download_images(url_candidates, proxy=proxy)
+        
+        if images:
+            _print_timings({"提取": time.monotonic_ns() - _t_extract})
+            return images if return_all else images[0]
         
         # If we get here, no image data was found
         logger.error(f"响应中未找到图片数据，Parts 数量: {len(parts)}")
@@ -1119,35 +1416,97 @@ def decode_base64_image(base64_string):
         PIL.Image: Decoded image
     """
     try:
-        logger.debug("Decoding base64 image...")
+        # 先一次性转成 bytes（b64decode 对 str 输入内部同样要做这次转换），
+        # 之后的去前缀/去空白都在 memoryview 上切片，不再复制整个负载
+        if isinstance(base64_string, str):
+            base64_string = base64_string.encode('ascii')
+        payload = memoryview(base64_string)
         
         # 1. 移除 data URI 前缀 (如果存在)
-        if base64_string.startswith('data:'):
+        if base64_string.startswith(b'data:'):
             # 格式: data:image/png;base64,xxxxx
-            comma_idx = base64_string.find(',')
+            comma_idx = base64_string.find(b',', 0, 256)
             if comma_idx != -1:
-                base64_string = base64_string[comma_idx + 1:]
+                payload = payload[comma_idx + 1:]
                 logger.debug("Removed data URI prefix")
         
         # 2. 移除可能的空白字符
-        base64_string = base64_string.strip()
+        # 接口返回的 base64 通常已是干净的，只有首尾确实有空白时才 strip（罕见情况，允许一次复制）
+        if payload and (payload[:1].tobytes().isspace() or payload[-1:].tobytes().isspace()):
+            payload = memoryview(payload.tobytes().strip())
         
         # 3. 修复 Base64 填充问题
         # Base64 字符串长度必须是 4 的倍数，不足的用 '=' 填充
-        padding_needed = len(base64_string) % 4
+        # 格式正确的响应长度已是 4 的倍数（padding_needed == 0），直接跳过，只有需要补齐时才复制
+        padding_needed = (-len(payload)) & 3
         if padding_needed:
-            base64_string += '=' * (4 - padding_needed)
-            logger.debug(f"Added {4 - padding_needed} padding characters")
+            payload = memoryview(payload.tobytes() + b'==='[:padding_needed])
+            logger.debug("Added %d padding characters", padding_needed)
         
-        image_data = base64.b64decode(base64_string)
+        image_data = _b64.b64decode(payload, validate=False)
+        # BytesIO 包装不可变 bytes 时共享同一块内存（不复制）；
+        # 立即 load() 完成解码，使压缩数据和 BytesIO 可以在返回后立刻释放
         image = Image.open(io.BytesIO(image_data))
+        image.load()
         return image
     except Exception as e:
         logger.error(f"Failed to decode base64 image: {str(e)}")
         raise
 
 
-def download_image_from_url(url, max_retries=3, proxy=""):
+def _compute_backoff(attempt, response=None, base=1.0, cap=30.0):
+    """
+    计算重试前的等待时间（秒）
+    
+    优先使用响应头中的 Retry-After（秒数或 HTTP 日期）；否则使用带随机抖动的指数退避，
+    避免多个并发请求在同一时刻集中重试。
+    
+    Args:
+        attempt (int): 当前尝试次数（从 1 开始）
+        response (requests.Response): 失败的响应（可选）
+        base (float): 退避基数（秒）
+        cap (float): 最长等待时间（秒）
+        
+    Returns:
+        float: 等待时间（秒）
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(cap, max(0.0, float(retry_after)))
+            except ValueError:
+                try:
+                    retry_at = email.utils.parsedate_to_datetime(retry_after)
+                    return min(cap, max(0.0, retry_at.timestamp() - time.time()))
+                except (TypeError, ValueError):
+                    pass
+    return random.uniform(0.5, 1.5) * min(cap, base * 2 ** attempt)
+
+
+def _interruptible_sleep(seconds, cancel_event=None):
+    """
+    可取消的等待：每 0.5 秒检查一次取消信号，而不是整段阻塞当前线程
+    
+    Args:
+        seconds (float): 等待时间（秒）
+        cancel_event (threading.Event): 可选的取消事件，被设置时立即唤醒并抛出异常
+    """
+    deadline = time.monotonic() + seconds
+    while True:
+        if cancel_event is not None and cancel_event.is_set():
+            raise Exception("❌ 操作已取消")
+        _check_interrupted()
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if cancel_event is not None:
+            cancel_event.wait(min(0.5, remaining))
+        else:
+            time.sleep(min(0.5, remaining))
+
+
+def download_image_from_url(url, max_retries=3, proxy="", cancel_event=None):
     """
     Download image from URL and convert to PIL Image
     
@@ -1155,11 +1514,12 @@ def download_image_from_url(url, max_retries=3, proxy=""):
         url (str): URL of the image
         max_retries (int): Maximum number of retry attempts
         proxy (str): 可选的代理地址
+        cancel_event (threading.Event): 可选的取消事件，重试等待期间被设置时立即停止
         
     Returns:
         PIL.Image: Downloaded image
     """
-    logger.debug(f"正在下载图片")
+    logger.debug("正在下载图片")
     
     # 构建代理配置：优先使用用户传入的 proxy，其次使用全局配置
     user_proxy = proxy.strip() if proxy else None
@@ -1169,58 +1529,78 @@ def download_image_from_url(url, max_retries=3, proxy=""):
     # 注意：代理信息已在 extract_image_from_gemini_response 中显示，这里不再重复显示
     
     last_error = None
+    wait_time = 0
     for attempt in range(1, max_retries + 1):
+        # 等待放在 try 之外：取消产生的异常不能被下面的 except 当作下载错误而继续重试
+        if attempt > 1:
+            print(f"   重试下载 ({attempt}/{max_retries})...", flush=True)
+            _interruptible_sleep(wait_time, cancel_event)  # 重试前等待（带随机抖动的指数退避）
+        
         try:
-            if attempt > 1:
-                print(f"   重试下载 ({attempt}/{max_retries})...", flush=True)
-                time.sleep(2)  # 重试前等待2秒
-            
             # 使用 stream=True 分块下载，更好地处理大文件和超时
-            response = requests.get(
+            # with 块结束时自动关闭响应，连接归还连接池
+            with _SESSION.get(
                 url, 
                 timeout=(10, 120),  # (连接超时, 读取超时) - 连接10秒，读取120秒
-                verify=False,  # 禁用 SSL 验证
                 stream=True,
-                proxies=proxies_dict  # 使用代理加速下载
-            )
-            response.raise_for_status()
-            
-            # 确认代理使用情况（仅在提取图片数据阶段显示）
-            if active_proxy:
-                via_header = response.headers.get('Via', '')
-                if via_header:
-                    print(f"    ✅ 代理已生效", flush=True)
-                else:
-                    print(f"    ✅ 代理已应用", flush=True)
-            
-            # 获取内容长度（如果有）
-            content_length = response.headers.get('content-length')
-            if content_length:
-                size_mb = int(content_length) / (1024 * 1024)
-                logger.debug(f"Image size: {size_mb:.2f} MB")
-            
-            # 读取全部内容
-            image_data = response.content
-            image = Image.open(io.BytesIO(image_data))
+                proxies=proxies_dict,  # 使用代理加速下载
+                verify=False,  # 禁用 SSL 验证（环境变量中的 CA bundle 会覆盖 session.verify）
+            ) as response:
+                response.raise_for_status()
+                
+                # 确认代理使用情况（仅在提取图片数据阶段显示）
+                if active_proxy:
+                    via_header = response.headers.get('Via', '')
+                    if via_header:
+                        print(f"    ✅ 代理已生效", flush=True)
+                    else:
+                        print(f"    ✅ 代理已应用", flush=True)
+                
+                # 获取内容长度（如果有，仅调试模式下计算）
+                if logger.isEnabledFor(logging.DEBUG):
+                    content_length = response.headers.get('content-length')
+                    if content_length:
+                        logger.debug("Image size: %.2f MB", int(content_length) / (1024 * 1024))
+                
+                # 直接从响应流解析图片，不先生成完整的 response.content 再复制到 BytesIO
+                # load() 必须在 with 块内完成，确保关闭连接前图片数据已全部读取并解码
+                response.raw.decode_content = True  # 处理 gzip 等传输编码
+                image = Image.open(response.raw)
+                image.load()
             return image
             
         except requests.exceptions.ConnectTimeout:
             last_error = "连接超时，无法连接到图片服务器"
             logger.warning(f"Connection timeout (attempt {attempt}/{max_retries})")
+            wait_time = _compute_backoff(attempt)
         except requests.exceptions.ReadTimeout:
             last_error = "读取超时，下载图片时间过长"
             logger.warning(f"Read timeout (attempt {attempt}/{max_retries})")
+            wait_time = _compute_backoff(attempt)
         except requests.exceptions.ConnectionError as e:
             last_error = f"网络连接错误: {str(e)}"
             logger.warning(f"Connection error (attempt {attempt}/{max_retries}): {str(e)}")
+            wait_time = _compute_backoff(attempt)
         except requests.exceptions.HTTPError as e:
-            # HTTP 错误（4xx, 5xx）不重试
-            status_code = e.response.status_code if e.response else "unknown"
+            # 注意：Response 的布尔值表示是否成功，错误响应为 False，必须用 is not None 判断
+            error_response = e.response
+            status_code = error_response.status_code if error_response is not None else "unknown"
+            if error_response is not None:
+                error_response.close()
+            
+            # 429 和 5xx 是临时错误，重试（优先遵循服务器的 Retry-After）；其他 4xx 不重试
+            if status_code == 429 or (isinstance(status_code, int) and status_code >= 500):
+                last_error = f"服务器暂时不可用 (HTTP {status_code})"
+                logger.warning(f"HTTP error {status_code} (attempt {attempt}/{max_retries})")
+                wait_time = _compute_backoff(attempt, error_response, cap=60.0 if status_code == 429 else 30.0)
+                continue
+            
             logger.error(f"HTTP error {status_code}: {str(e)}")
             raise Exception(f"下载图片失败: 图片链接可能已过期或不可访问")
         except Exception as e:
             last_error = str(e)
             logger.warning(f"Download error (attempt {attempt}/{max_retries}): {str(e)}")
+            wait_time = _compute_backoff(attempt)
     
     # 所有重试都失败了
     error_msg = (
@@ -1249,6 +1629,24 @@ UPSCALE_METHODS = {
     "hamming": Image.Resampling.HAMMING,
 }
 
+# 缩放方法查找表：预置小写和大写两种写法，常见输入无需每次调用 lower()
+# （UPSCALE_METHODS 本身用作节点下拉选项，不能加入大写键）
+_UPSCALE_METHOD_LOOKUP = {
+    **UPSCALE_METHODS,
+    **{name.upper(): method for name, method in UPSCALE_METHODS.items()},
+}
+
+# 张量缩放时对应的 torch.nn.functional.interpolate 模式
+# torch 没有 lanczos/hamming，使用带抗锯齿的 bicubic/bilinear 近似；box 对应 area（区域平均）
+TORCH_INTERPOLATE_MODES = {
+    "lanczos": "bicubic",
+    "nearest": "nearest-exact",
+    "bilinear": "bilinear",
+    "bicubic": "bicubic",
+    "box": "area",
+    "hamming": "bilinear",
+}
+
 # 支持的最大尺寸选项
 MAX_DIM_OPTIONS = ["auto", "512", "768", "1024", "1280", "1536", "2048", "2560", "3072", "4096"]
 
@@ -1289,8 +1687,14 @@ def resize_image_to_max_dim(pil_image, max_dim="auto", upscale_method="lanczos")
     new_width = int(width * scale)
     new_height = int(height * scale)
     
+    # 尺寸未变化时直接返回原图
+    if new_width == width and new_height == height:
+        return pil_image
+    
     # 获取缩放方法
-    resample_method = UPSCALE_METHODS.get(upscale_method.lower(), Image.Resampling.LANCZOS)
+    resample_method = _UPSCALE_METHOD_LOOKUP.get(upscale_method)
+    if resample_method is None:
+        resample_method = _UPSCALE_METHOD_LOOKUP.get(upscale_method.lower(), Image.Resampling.LANCZOS)
     
     # 执行缩放
     logger.debug(f"缩放图像: {width}x{height} -> {new_width}x{new_height} (方法: {upscale_method})")
@@ -1299,10 +1703,29 @@ def resize_image_to_max_dim(pil_image, max_dim="auto", upscale_method="lanczos")
     return resized_image
 
 
+def _lanczos_weights(in_size, out_size, device, dtype, a=3):
+    """
+    构建一维 lanczos 缩放权重矩阵 (out_size, in_size)，与 PIL 的 LANCZOS 采样方式一致
+    
+    缩小时按缩放比例放大核的支撑范围（抗锯齿），每行权重归一化。
+    """
+    scale = in_size / out_size
+    support_scale = max(scale, 1.0)
+    centers = (torch.arange(out_size, device=device, dtype=torch.float32) + 0.5) * scale
+    src = torch.arange(in_size, device=device, dtype=torch.float32) + 0.5
+    d = (src[None, :] - centers[:, None]) / support_scale
+    weights = torch.sinc(d) * torch.sinc(d / a)
+    weights = torch.where(d.abs() < a, weights, torch.zeros_like(weights))
+    weights = weights / weights.sum(dim=1, keepdim=True)
+    return weights.to(dtype)
+
+
 def resize_comfy_image_to_max_dim(image_tensor, max_dim="auto", upscale_method="lanczos"):
     """
     将 ComfyUI 图像张量缩放到指定的最大尺寸（保持宽高比）
     
+    整个批次一次性在张量所在设备上缩放（CUDA 张量直接在 GPU 上完成），不经过 PIL 转换
+    
     Args:
         image_tensor (torch.Tensor): ComfyUI 图像张量 (B, H, W, C)
         max_dim (str): 最大尺寸，"auto" 表示不缩放
@@ -1315,30 +1738,54 @@ def resize_comfy_image_to_max_dim(image_tensor, max_dim="auto", upscale_method="
     if max_dim == "auto" or not max_dim:
         return image_tensor
     
-    # 处理批量图像
-    batch_size = image_tensor.shape[0]
-    resized_images = []
+    try:
+        target_max_dim = int(max_dim)
+    except ValueError:
+        logger.warning(f"无效的 max_dim 值: {max_dim}，跳过缩放")
+        return image_tensor
+    
+    # 批次内所有图像尺寸相同，按同一比例缩放
+    height, width = image_tensor.shape[1], image_tensor.shape[2]
+    current_max_dim = max(width, height)
     
-    for i in range(batch_size):
-        # 提取单张图像并转换为 PIL
-        single_image = image_tensor[i]  # (H, W, C)
-        np_image = (single_image.numpy() * 255).astype(np.uint8)
-        pil_image = Image.fromarray(np_image)
-        
-        # 缩放
-        resized_pil = resize_image_to_max_dim(pil_image, max_dim, upscale_method)
-        
-        # 转回张量
-        resized_np = np.array(resized_pil).astype(np.float32) / 255.0
-        resized_tensor = torch.from_numpy(resized_np)
-        resized_images.append(resized_tensor)
+    # 如果图像已经小于等于目标尺寸，不做处理
+    if current_max_dim <= target_max_dim:
+        return image_tensor
+    
+    # 计算缩放比例（与 resize_image_to_max_dim 保持一致）
+    scale = target_max_dim / current_max_dim
+    new_width = int(width * scale)
+    new_height = int(height * scale)
+    
+    method = upscale_method.lower()
+    
+    # CUDA 上使用可分离的 lanczos 权重矩阵做两次矩阵乘法，结果与 PIL 的 lanczos 一致；
+    # CPU 上稠密矩阵乘法代价过高，仍使用带抗锯齿的 bicubic 近似
+    if method == "lanczos" and image_tensor.is_cuda:
+        weights_h = _lanczos_weights(height, new_height, image_tensor.device, image_tensor.dtype)
+        weights_w = _lanczos_weights(width, new_width, image_tensor.device, image_tensor.dtype)
+        y = torch.einsum("oh,bhwc->bowc", weights_h, image_tensor)
+        y = torch.einsum("pw,bowc->bopc", weights_w, y)
+        return y.clamp_(0.0, 1.0).contiguous()
+    
+    mode = TORCH_INTERPOLATE_MODES.get(method, "bicubic")
+    smooth = mode in ("bilinear", "bicubic")
+    
+    # (B, H, W, C) -> (B, C, H, W)
+    # BHWC 连续张量 permute 后正好是 channels_last 布局（不复制）；interpolate 会保持该布局，
+    # 因此输出直接写入一块 (B, newH, newW, C) 连续内存，最后 permute 回去也无需再复制
+    x = image_tensor.permute(0, 3, 1, 2).contiguous(memory_format=torch.channels_last)
+    if smooth:
+        y = F.interpolate(x, size=(new_height, new_width), mode=mode, align_corners=False, antialias=True)
+    else:
+        y = F.interpolate(x, size=(new_height, new_width), mode=mode)
     
-    # 合并为批量张量
-    # 注意：如果图像尺寸不同，需要特殊处理
-    # 但由于都按同一比例缩放，尺寸应该相同
-    result = torch.stack(resized_images, dim=0)
+    # bicubic 插值可能超出 [0, 1]（PIL 转 uint8 时会自然截断，这里需要手动截断）
+    if mode == "bicubic":
+        y = y.clamp_(0.0, 1.0)
     
-    return result
+    # channels_last 输出在这里已是连续的 BHWC，contiguous() 不会产生拷贝
+    return y.permute(0, 2, 3, 1).contiguous()
 
 
 def pil_to_comfy_image(pil_image):
@@ -1351,64 +1798,166 @@ def pil_to_comfy_image(pil_image):
     Returns:
         torch.Tensor: Image in ComfyUI format (1, H, W, C) with values in [0, 1]
     """
-    # Convert to RGB if necessary
+    # Convert to RGB if necessary (already-RGB images skip conversion entirely)
+    # 带透明通道的图片先合成到白色背景上，避免透明区域变成黑色
     if pil_image.mode != 'RGB':
-        pil_image = pil_image.convert('RGB')
+        if pil_image.mode in ('RGBA', 'LA') or (pil_image.mode == 'P' and 'transparency' in pil_image.info):
+            rgba_image = pil_image.convert('RGBA')
+            background = Image.new('RGBA', rgba_image.size, (255, 255, 255, 255))
+            pil_image = Image.alpha_composite(background, rgba_image).convert('RGB')
+        else:
+            # 其他模式（L、P、CMYK、I;16 等）统一转换为 8 位 RGB
+            pil_image = pil_image.convert('RGB')
     
-    # Convert to numpy array
-    np_image = np.array(pil_image).astype(np.float32) / 255.0
+    # Convert to a uint8 numpy array (one copy), then cast to float32 once inside torch
+    # 只产生一次 float32 分配（div_ 原地执行），避免 numpy 中间的 float32 数组
+    np_image = np.array(pil_image, dtype=np.uint8)
     
     # Add batch dimension and convert to torch tensor
-    tensor_image = torch.from_numpy(np_image)[None,]
+    tensor_image = torch.from_numpy(np_image).to(torch.float32).div_(255.0).unsqueeze_(0)
     
-    logger.debug(f"Converted to ComfyUI tensor: {tensor_image.shape}")
+    logger.debug("Converted to ComfyUI tensor: %s", tensor_image.shape)
     return tensor_image
 
 
-def comfy_image_to_base64(image_tensor):
+# 上传编码格式 -> (MIME 类型, 文件扩展名)
+_UPLOAD_FORMATS = MappingProxyType({
+    "PNG": ("image/png", "png"),
+    "JPEG": ("image/jpeg", "jpg"),
+    "WEBP": ("image/webp", "webp"),
+})
+
+# base64 文本开头 -> 上传格式（由文件头魔数编码而来，无需解码即可判断）
+#   PNG:  \x89PNG  -> "iVBORw0KGgo"
+#   JPEG: \xff\xd8\xff -> "/9j/"
+#   WEBP: RIFF    -> "UklGR"
+_BASE64_SIGNATURES = (
+    ("iVBORw0KGgo", "PNG"),
+    ("/9j/", "JPEG"),
+    ("UklGR", "WEBP"),
+)
+
+
+def _sniff_base64_image_type(image_base64):
+    """
+    根据 base64 数据开头判断图片格式，返回 (MIME 类型, 文件扩展名)，无法识别时按 PNG 处理
+    """
+    for signature, fmt in _BASE64_SIGNATURES:
+        if image_base64.startswith(signature):
+            return _UPLOAD_FORMATS[fmt]
+    return _UPLOAD_FORMATS["PNG"]
+
+
+# 每个线程复用一个编码缓冲区，避免每次编码都从空 BytesIO 开始反复扩容复制
+_TLS = threading.local()
+
+
+def _get_encode_buffer():
+    """
+    获取当前线程的编码缓冲区，并将写入位置移到开头
+    
+    注意：不调用 truncate(0)，BytesIO 截断到远小于容量时会释放已分配的内存，失去复用的意义；
+    旧数据会被新数据覆盖，读取时只取 tell() 之前的部分
+    """
+    buffer = getattr(_TLS, "encode_buffer", None)
+    if buffer is None:
+        buffer = _TLS.encode_buffer = io.BytesIO()
+    buffer.seek(0)
+    return buffer
+
+
+def comfy_image_to_base64(image_tensor, fmt="PNG", quality=90):
     """
     Convert ComfyUI IMAGE tensor to base64 string (without data URI prefix)
     
+    参考图上传后会由服务端的生成模型重新处理，无损 PNG 的精度并无必要；
+    对 4K 参考图使用 JPEG/WEBP 可使上传体积缩小约一个数量级。
+    接口调用时会根据 base64 内容自动识别格式并设置对应的 MIME 类型。
+    
     Args:
         image_tensor (torch.Tensor): ComfyUI IMAGE tensor (B, H, W, C) with values in [0, 1]
+        fmt (str): 编码格式，"PNG"（默认，无损）、"JPEG" 或 "WEBP"
+        quality (int): JPEG/WEBP 的编码质量 (1-100)，PNG 忽略此参数
         
     Returns:
-        str: Base64 encoded PNG image (raw base64, no prefix)
+        str: Base64 encoded image (raw base64, no prefix)
     """
-    # Remove batch dimension and convert to numpy
-    np_image = (image_tensor.squeeze(0).numpy() * 255).astype(np.uint8)
+    fmt = fmt.upper()
+    if fmt == "JPG":
+        fmt = "JPEG"
+    if fmt not in _UPLOAD_FORMATS:
+        raise ValueError(f"不支持的编码格式: {fmt}，可选: {', '.join(_UPLOAD_FORMATS)}")
+    
+    # Remove batch dimension, scale and cast to uint8 inside torch, then convert to numpy
+    # clamp() 返回新张量，后续 mul_ 原地执行，不会修改调用方的输入张量
+    # detach() 保证带梯度的张量也能转 numpy；GPU 张量先在显卡上转成 uint8，
+    # 再拷回内存（传输量只有 float32 的 1/4），CPU 张量的 .cpu() 不产生复制
+    np_image = (
+        image_tensor.detach().squeeze(0).clamp(0.0, 1.0).mul_(255)
+        .to(torch.uint8).cpu().contiguous().numpy()
+    )
     
     # Convert to PIL Image
     pil_image = Image.fromarray(np_image)
     
     # Convert to base64
-    buffer = io.BytesIO()
-    pil_image.save(buffer, format="PNG")
-    base64_string = base64.b64encode(buffer.getvalue()).decode('utf-8')
-    
-    logger.debug(f"Converted tensor to base64 (size: {pil_image.size})")
+    buffer = _get_encode_buffer()
+    if fmt == "PNG":
+        # 上传前的临时编码，压缩级别见 PNG_COMPRESS_LEVEL
+        pil_image.save(buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL, optimize=False)
+    else:
+        # JPEG 不支持透明通道
+        if fmt == "JPEG" and pil_image.mode != "RGB":
+            pil_image = pil_image.convert("RGB")
+        pil_image.save(buffer, format=fmt, quality=quality, optimize=False)
+    # getbuffer() 直接暴露内部缓冲区（memoryview），省去 getvalue() 的一次完整复制；
+    # 缓冲区复用且不截断，只取本次写入的部分
+    encoded_size = buffer.tell()
+    with buffer.getbuffer() as buffer_view, buffer_view[:encoded_size] as encoded_view:
+        base64_string = _b64encode_as_string(encoded_view)
+    
+    logger.debug("Converted tensor to base64 (size: %s)", pil_image.size)
     return base64_string
 
 
+def comfy_images_to_base64(image_tensors, fmt="PNG", quality=90):
+    """
+    批量将 ComfyUI IMAGE 张量转换为 base64 字符串，多于一张时并发编码
+    （PNG/JPEG 压缩和 base64 编码在 C 实现中释放 GIL，可利用多个 CPU 核心）
+    
+    Args:
+        image_tensors (list): ComfyUI IMAGE 张量列表
+        fmt (str): 编码格式，见 comfy_image_to_base64
+        quality (int): JPEG/WEBP 的编码质量
+        
+    Returns:
+        list: base64 字符串列表，顺序与 image_tensors 一致
+    """
+    if len(image_tensors) <= 1:
+        return [comfy_image_to_base64(image_tensor, fmt, quality) for image_tensor in image_tensors]
+    with ThreadPoolExecutor(max_workers=min(8, len(image_tensors))) as executor:
+        return list(executor.map(lambda image_tensor: comfy_image_to_base64(image_tensor, fmt, quality), image_tensors))
+
+
 def process_api_response(response_data, proxy=""):
     """
     Process API response and return PIL Image
     
     支持两种格式:
     1. Gemini 格式 - 从 candidates/content/parts 中提取图片
-    2. OpenAI 格式 - 直接从包装的 _openai_pil_image 字段获取
+    2. OpenAI 格式 - call_nano_banana_api 已直接返回 PIL.Image，原样返回
     
     Args:
-        response_data (dict): API response data
+        response_data (dict | PIL.Image): API response data
         proxy (str): 可选的代理地址，用于下载图片
         
     Returns:
         PIL.Image: Generated image
     """
     try:
-        # 检查是否是 OpenAI 格式的包装响应
-        if "_openai_pil_image" in response_data:
-            return response_data["_openai_pil_image"]
+        # OpenAI 格式：已经是图片
+        if isinstance(response_data, Image.Image):
+            return response_data
         
         # 原有逻辑：处理 Gemini 格式
         return extract_image_from_gemini_response(response_data, proxy=proxy)
@@ -1422,28 +1971,83 @@ def format_time(seconds):
     """将秒数格式化为可读时间"""
     if seconds is None:
         return "未知"
+    # 输出精度为整秒，按整数秒缓存（进度更新时反复出现相同的值）
+    return _format_time_int(int(seconds))
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_time_int(seconds):
+    """format_time 的实现，参数为整数秒"""
     if seconds < 60:
-        return f"{int(seconds)}秒"
-    elif seconds < 3600:
-        mins = int(seconds // 60)
-        secs = int(seconds % 60)
-        return f"{mins}分{secs}秒"
-    else:
-        hours = int(seconds // 3600)
-        mins = int((seconds % 3600) // 60)
+        return f"{seconds}秒"
+    hours, rem = divmod(seconds, 3600)
+    mins, secs = divmod(rem, 60)
+    if hours:
         return f"{hours}小时{mins}分"
+    return f"{mins}分{secs}秒"
 
 
-def load_images_from_folder(folder_path, file_pattern="*.png,*.jpg,*.jpeg"):
+def _load_image_file(file_path, target_size=None):
     """
-    从文件夹加载图片
+    加载单张图片并转换为 RGB
+    
+    Args:
+        file_path (str): 图片文件路径
+        target_size (tuple): 见 _decode_image_bytes
+        
+    Returns:
+        tuple: (PIL Image对象 或 None, 文件名, 异常 或 None)
+    """
+    filename = os.path.basename(file_path)
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    except Exception as e:
+        return None, filename, e
+    return _decode_image_bytes(data, filename, target_size)
+
+
+def _decode_image_bytes(data, filename, target_size=None):
+    """
+    从内存中的文件内容解码图片并转换为 RGB（供线程池调用）
+    
+    Args:
+        data (bytes): 图片文件内容
+        filename (str): 文件名（仅用于返回值）
+        target_size (tuple): 可选的 (宽, 高)，JPEG 按不小于该尺寸的 1/2、1/4、1/8 比例直接降采样解码
+        
+    Returns:
+        tuple: (PIL Image对象 或 None, 文件名, 异常 或 None)
+    """
+    try:
+        img = Image.open(io.BytesIO(data))
+        # draft() 让 libjpeg 在 IDCT 阶段直接按比例缩小解码，解码数据量按比例平方减少
+        if target_size and img.format == 'JPEG':
+            img.draft('RGB', target_size)
+        # 转换为RGB（如果需要）；已是 RGB 时立即 load()，确保解码在工作线程中完成
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        else:
+            img.load()
+        return img, filename, None
+    except Exception as e:
+        return None, filename, e
+
+
+# 扩展名模式："*.png"、"*.tar.gz"、".png"，或不带点的简写 "png"（扩展名只含字母和数字）
+_EXT_PATTERN_RE = re.compile(r'^(?:\*?\.([A-Za-z0-9]+(?:\.[A-Za-z0-9]+)*)|([A-Za-z0-9]+))$')
+
+
+def _list_image_files(folder_path, file_pattern):
+    """
+    列出文件夹中匹配模式的文件（按路径排序，不区分大小写）
     
     Args:
         folder_path (str): 文件夹路径
         file_pattern (str): 文件过滤模式，逗号分隔（如 "*.png,*.jpg,*.jpeg"）
         
     Returns:
-        tuple: (PIL Image对象列表, 文件名列表)
+        list: 文件路径列表
     """
     if not os.path.exists(folder_path):
         raise ValueError(f"文件夹不存在: {folder_path}")
@@ -1452,16 +2056,158 @@ def load_images_from_folder(folder_path, file_pattern="*.png,*.jpg,*.jpeg"):
         raise ValueError(f"路径不是文件夹: {folder_path}")
     
     # 解析文件模式
-    patterns = [p.strip() for p in file_pattern.split(',')]
+    # 扩展名模式（"*.png"，以及常见的简写 ".png" / "png"）合并为一个小写后缀元组，
+    # 用 str.endswith 直接匹配（不区分大小写）；其他模式使用 fnmatch
+    exts = []
+    other_patterns = []
+    for pattern in file_pattern.split(','):
+        pattern = pattern.strip()
+        if not pattern:
+            continue
+        ext_match = _EXT_PATTERN_RE.match(pattern)
+        if ext_match:
+            exts.append('.' + (ext_match.group(1) or ext_match.group(2)).lower())
+        else:
+            other_patterns.append(pattern)
+    exts = tuple(dict.fromkeys(exts))
+    # 其他模式合并为一个预编译正则（大小写规则与 fnmatch.fnmatch 一致：Windows 不区分大小写）
+    other_re = None
+    if other_patterns:
+        flags = re.IGNORECASE if os.path.normcase('A') == 'a' else 0
+        other_re = re.compile('|'.join(fnmatch.translate(p) for p in other_patterns), flags)
+    
+    # 单次 scandir 遍历收集所有匹配的文件（每个条目只出现一次，无需去重）
+    # 与 glob 行为一致：跳过隐藏文件；is_file() 放在最后，只对名称匹配的条目检查类型
+    with os.scandir(folder_path) as it:
+        image_files = [
+            entry.path for entry in it
+            if not entry.name.startswith('.')
+            and (entry.name.lower().endswith(exts)
+                 or (other_re is not None and other_re.match(entry.name)))
+            and entry.is_file()
+        ]
+    # 原地排序一次，不区分大小写（"B.png" 与 "a.jpg" 按字母顺序排列，与文件管理器一致）
+    image_files.sort(key=str.lower)
+    return image_files
+
+
+def _read_ahead(image_files, executor, target_size, out_queue, stop_event):
+    """
+    读取线程：按顺序读取文件内容并提交解码任务，把 Future 依次放入有界队列，结束时放入 None
     
-    # 收集所有匹配的文件
-    image_files = []
-    for pattern in patterns:
-        matching_files = glob.glob(os.path.join(folder_path, pattern))
-        image_files.extend(matching_files)
+    Args:
+        image_files (list): 图片文件路径列表
+        executor (ThreadPoolExecutor): 解码线程池
+        target_size (tuple): 见 _decode_image_bytes
+        out_queue (queue.Queue): 有界结果队列（队列满时读取线程阻塞，限制内存占用）
+        stop_event (threading.Event): 消费方提前结束时置位，读取线程随即退出
+    """
+    def put(item):
+        while not stop_event.is_set():
+            try:
+                out_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
     
-    # 去重并排序
-    image_files = sorted(set(image_files))
+    try:
+        for path in image_files:
+            filename = os.path.basename(path)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except Exception as e:
+                future = Future()
+                future.set_result((None, filename, e))
+            else:
+                future = executor.submit(_decode_image_bytes, data, filename, target_size)
+            if not put(future):
+                return
+    finally:
+        put(None)
+
+
+def _iter_loaded_images(image_files, target_size=None):
+    """
+    按顺序逐个产出图片文件的加载结果（生成器）
+    
+    读取与解码流水线并行：一个读取线程顺序读取文件内容（磁盘保持顺序读），
+    多个线程并发解码（PIL 解码时会释放 GIL）。两者通过有界队列衔接：
+    任意时刻驻留内存的文件内容和已解码图片为 O(线程数) 份，而不是整个文件夹
+    
+    Args:
+        image_files (list): 图片文件路径列表
+        target_size (tuple): 见 _decode_image_bytes
+        
+    Yields:
+        tuple: (PIL Image对象 或 None, 文件名, 异常 或 None)，顺序与 image_files 一致
+    """
+    # 只有一张图片时直接在当前线程解码，省去创建线程池的开销
+    if len(image_files) == 1:
+        yield _load_image_file(image_files[0], target_size)
+        return
+    
+    max_workers = min(16, (os.cpu_count() or 1) * 2, len(image_files))
+    pending = queue.Queue(maxsize=max_workers * 2)
+    stop_event = threading.Event()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        reader = threading.Thread(
+            target=_read_ahead,
+            args=(image_files, executor, target_size, pending, stop_event),
+            daemon=True,
+        )
+        reader.start()
+        try:
+            while True:
+                future = pending.get()
+                if future is None:
+                    break
+                yield future.result()
+        finally:
+            # 消费方提前结束（如生成器被关闭）时通知读取线程退出，并等待其结束后再关闭线程池
+            stop_event.set()
+            reader.join()
+
+
+def iter_images_from_folder(folder_path, file_pattern="*.png,*.jpg,*.jpeg", target_size=None):
+    """
+    逐张加载文件夹中的图片（生成器），适合图片很多、无法全部放入内存的文件夹
+    
+    Args:
+        folder_path (str): 文件夹路径
+        file_pattern (str): 文件过滤模式，逗号分隔（如 "*.png,*.jpg,*.jpeg"）
+        target_size (tuple): 见 load_images_from_folder
+        
+    Yields:
+        tuple: (PIL Image对象, 文件名)；加载失败的文件记录错误后跳过
+    """
+    image_files = _list_image_files(folder_path, file_pattern)
+    if len(image_files) == 0:
+        logger.warning(f"在文件夹 {folder_path} 中未找到匹配 {file_pattern} 的文件")
+        return
+    
+    for img, filename, error in _iter_loaded_images(image_files, target_size):
+        if img is None:
+            logger.error(f"无法加载图片 {filename}: {str(error)}")
+            continue
+        yield img, filename
+
+
+def load_images_from_folder(folder_path, file_pattern="*.png,*.jpg,*.jpeg", target_size=None):
+    """
+    从文件夹加载图片
+    
+    Args:
+        folder_path (str): 文件夹路径
+        file_pattern (str): 文件过滤模式，逗号分隔（如 "*.png,*.jpg,*.jpeg"）
+        target_size (tuple): 可选的 (宽, 高)，后续会缩小使用时传入，JPEG 可直接以较小尺寸解码
+            （得到的图片不小于该尺寸，仍需调用方自行缩放到精确尺寸）
+        
+    Returns:
+        tuple: (PIL Image对象列表, 文件名列表)
+    """
+    image_files = _list_image_files(folder_path, file_pattern)
     
     if len(image_files) == 0:
         logger.warning(f"在文件夹 {folder_path} 中未找到匹配 {file_pattern} 的文件")
@@ -1472,18 +2218,14 @@ def load_images_from_folder(folder_path, file_pattern="*.png,*.jpg,*.jpeg"):
     filenames = []
     failed_files = []
     
-    for file_path in image_files:
-        try:
-            img = Image.open(file_path)
-            # 转换为RGB（如果需要）
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
+    for img, filename, error in _iter_loaded_images(image_files, target_size):
+        if img is not None:
             images.append(img)
-            filenames.append(os.path.basename(file_path))
-            logger.debug(f"已加载: {os.path.basename(file_path)}")
-        except Exception as e:
-            failed_files.append(os.path.basename(file_path))
-            logger.error(f"无法加载图片 {os.path.basename(file_path)}: {str(e)}")
+            filenames.append(filename)
+            logger.debug("已加载: %s", filename)
+        else:
+            failed_files.append(filename)
+            logger.error(f"无法加载图片 {filename}: {str(error)}")
     
     if failed_files:
         logger.warning(f"加载失败的文件: {', '.join(failed_files)}")
@@ -1493,6 +2235,281 @@ def load_images_from_folder(folder_path, file_pattern="*.png,*.jpg,*.jpeg"):
     return images, filenames
 
 
+def load_images_as_array(folder_path, size, file_pattern="*.png,*.jpg,*.jpeg"):
+    """
+    从文件夹加载图片并缩放到统一尺寸，写入一个预分配的 (N, H, W, 3) uint8 数组
+    
+    适合后续直接使用 numpy 数组的批量处理：所有图片共用一块内存，
+    不再为每张图片单独创建数组再拼接
+    
+    Args:
+        folder_path (str): 文件夹路径
+        size (tuple): 目标尺寸 (宽, 高)
+        file_pattern (str): 文件过滤模式，逗号分隔（如 "*.png,*.jpg,*.jpeg"）
+        
+    Returns:
+        tuple: (形状为 (N, H, W, 3) 的 uint8 数组, 文件名列表)；加载失败的文件被跳过
+    """
+    width, height = size
+    image_files = _list_image_files(folder_path, file_pattern)
+    
+    out = np.empty((len(image_files), height, width, 3), dtype=np.uint8)
+    filenames = []
+    if len(image_files) == 0:
+        logger.warning(f"在文件夹 {folder_path} 中未找到匹配 {file_pattern} 的文件")
+        return out, filenames
+    
+    # target_size 让 JPEG 直接以接近目标的尺寸解码，再精确缩放到 size
+    for img, filename, error in _iter_loaded_images(image_files, target_size=(width, height)):
+        if img is None:
+            logger.error(f"无法加载图片 {filename}: {str(error)}")
+            continue
+        if img.size != (width, height):
+            img = img.resize((width, height), resample=Image.Resampling.LANCZOS)
+        out[len(filenames)] = np.frombuffer(img.tobytes(), dtype=np.uint8).reshape(height, width, 3)
+        filenames.append(filename)
+    
+    logger.info(f"成功加载 {len(filenames)}/{len(image_files)} 张图片")
+    
+    # 有加载失败的文件时返回前 N 行的视图，不再复制
+    return out[:len(filenames)], filenames
+
+
+def _read_file_tensor(file_path):
+    """读取文件内容为 uint8 张量（bytearray 可写，避免 torch.frombuffer 对只读缓冲区的警告）"""
+    with open(file_path, 'rb') as f:
+        return torch.frombuffer(bytearray(f.read()), dtype=torch.uint8)
+
+
+def _decode_jpegs_on_gpu(file_paths, device):
+    """
+    使用 nvJPEG 在 GPU 上解码 JPEG 文件
+    
+    Args:
+        file_paths (list): JPEG 文件路径列表
+        device (torch.device): CUDA 设备
+        
+    Returns:
+        list: ComfyUI IMAGE 张量 (1, H, W, 3)，解码失败的位置为 None
+    """
+    # 读取文件是 IO 操作，并发读取
+    with ThreadPoolExecutor(max_workers=min(16, len(file_paths))) as executor:
+        encoded = list(executor.map(_read_file_tensor, file_paths))
+    
+    try:
+        # torchvision >= 0.19 支持传入列表进行批量解码
+        decoded = _decode_jpeg(encoded, mode=_ImageReadMode.RGB, device=device)
+    except (TypeError, RuntimeError):
+        # 旧版本不支持批量，或批次中有无法解码的文件（如 CMYK）：逐张解码，失败的交给 PIL
+        decoded = []
+        for data in encoded:
+            try:
+                decoded.append(_decode_jpeg(data, mode=_ImageReadMode.RGB, device=device))
+            except RuntimeError:
+                decoded.append(None)
+    
+    # (C, H, W) uint8 -> (1, H, W, C) float32，先在 uint8 上整理内存布局再转换类型
+    return [
+        None if chw is None else
+        chw.permute(1, 2, 0).contiguous().unsqueeze_(0).to(torch.float32).div_(255.0)
+        for chw in decoded
+    ]
+
+
+def load_image_tensors_from_folder(folder_path, file_pattern="*.png,*.jpg,*.jpeg", device=None):
+    """
+    从文件夹加载图片，直接返回 ComfyUI IMAGE 张量
+    
+    在 CUDA 设备上，JPEG 通过 nvJPEG 在显卡上解码，结果直接留在显存中，
+    既不经过 CPU 上的 libjpeg，也省去 CPU→GPU 拷贝；其他格式或 GPU 解码失败的文件回退到 PIL。
+    
+    Args:
+        folder_path (str): 文件夹路径
+        file_pattern (str): 文件过滤模式，逗号分隔（如 "*.png,*.jpg,*.jpeg"）
+        device (str): 目标设备，None 表示 CUDA 可用时使用 CUDA，否则使用 CPU
+        
+    Returns:
+        tuple: (ComfyUI IMAGE 张量列表，每个为 (1, H, W, 3), 文件名列表)
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+    
+    image_files = _list_image_files(folder_path, file_pattern)
+    if len(image_files) == 0:
+        logger.warning(f"在文件夹 {folder_path} 中未找到匹配 {file_pattern} 的文件")
+        return [], []
+    
+    tensors = [None] * len(image_files)
+    
+    # JPEG 优先在 GPU 上解码
+    if device.type == "cuda" and _decode_jpeg is not None:
+        jpeg_indices = [i for i, path in enumerate(image_files) if path.lower().endswith(('.jpg', '.jpeg'))]
+        if jpeg_indices:
+            decoded = _decode_jpegs_on_gpu([image_files[i] for i in jpeg_indices], device)
+            for i, tensor in zip(jpeg_indices, decoded):
+                tensors[i] = tensor
+    
+    # 其余文件使用 PIL 多线程解码
+    pending = [i for i, tensor in enumerate(tensors) if tensor is None]
+    if pending:
+        max_workers = min(16, (os.cpu_count() or 1) * 2, len(pending))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_load_image_file, [image_files[i] for i in pending]))
+        for i, (img, filename, error) in zip(pending, results):
+            if img is None:
+                logger.error(f"无法加载图片 {filename}: {str(error)}")
+                continue
+            tensors[i] = pil_to_comfy_image(img).to(device)
+    
+    loaded = [(tensor, os.path.basename(path)) for tensor, path in zip(tensors, image_files) if tensor is not None]
+    logger.info(f"成功加载 {len(loaded)}/{len(image_files)} 张图片")
+    if not loaded:
+        return [], []
+    images, filenames = zip(*loaded)
+    return list(images), list(filenames)
+
+
+# 输出文件夹的已有文件名缓存：文件夹 -> [目录 mtime_ns, 文件名集合, {原文件名: 下一个待尝试的序号}]
+# 批量重复运行时大量文件名冲突，已知被占用的候选名直接在内存中跳过，不再逐个发起系统调用；
+# 同名文件连续保存时从上次的序号继续，而不是每次都从 _1 开始逐个检查；
+# 目录 mtime 与上次记录不一致（外部增删了文件）时重新扫描
+_DIR_NAME_CACHE = {}
+_DIR_NAME_CACHE_LOCK = threading.Lock()
+
+
+def _create_placeholder(output_path):
+    """以 O_CREAT | O_EXCL 原子地创建空文件，文件名已存在时抛出 FileExistsError"""
+    os.close(os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))  # 与 open() 相同，由 umask 决定最终权限
+
+
+def _claim_output_path(output_folder, filename, create=_create_placeholder):
+    """
+    在输出文件夹中占用一个不冲突的文件名（必要时添加 _1, _2... 后缀），返回完整路径
+    
+    create 必须原子地创建文件，并在文件名已存在时抛出 FileExistsError：
+    即使缓存过期，或其他进程同时写入同一文件夹，也不会相互覆盖
+    
+    Args:
+        output_folder (str): 输出文件夹路径
+        filename (str): 期望的文件名
+        create (callable): 接收完整路径、创建文件的函数，默认创建空的占位文件
+    """
+    name, ext = os.path.splitext(filename)
+    with _DIR_NAME_CACHE_LOCK:
+        mtime = os.stat(output_folder).st_mtime_ns
+        cached = _DIR_NAME_CACHE.get(output_folder)
+        if cached is None or cached[0] != mtime:
+            with os.scandir(output_folder) as it:
+                cached = _DIR_NAME_CACHE[output_folder] = [mtime, {entry.name for entry in it}, {}]
+        existing_names, next_counters = cached[1], cached[2]
+        
+        for counter in itertools.count(next_counters.get(filename, 0)):
+            candidate = filename if counter == 0 else f"{name}_{counter}{ext}"
+            if candidate in existing_names:
+                continue
+            output_path = os.path.join(output_folder, candidate)
+            try:
+                create(output_path)
+            except FileExistsError:
+                existing_names.add(candidate)
+                continue
+            existing_names.add(candidate)
+            next_counters[filename] = counter + 1
+            # 记录自身写入后的 mtime，下次调用时不会因为自己创建的文件而重新扫描
+            cached[0] = os.stat(output_folder).st_mtime_ns
+            break
+    
+    if counter:
+        logger.debug("文件已存在，重命名: %s -> %s", filename, candidate)
+    return output_path
+
+
+def _release_output_name(output_folder, name):
+    """保存失败、已删除占用文件后，从文件名缓存中移除该文件名（并让序号重新从头查找）"""
+    with _DIR_NAME_CACHE_LOCK:
+        cached = _DIR_NAME_CACHE.get(output_folder)
+        if cached is not None:
+            cached[1].discard(name)
+            cached[2].clear()
+
+
+# Linux 的 O_TMPFILE 在目录中创建没有文件名的临时文件，写完后通过 /proc/self/fd 链接到最终文件名：
+# 编码中途崩溃不会留下残缺的图片文件，且链接（linkat）本身就是原子的“文件名已存在则失败”操作
+_O_TMPFILE_SUPPORTED = hasattr(os, "O_TMPFILE") and os.path.isdir("/proc/self/fd")
+
+
+def _write_image(pil_image, f, save_format):
+    """
+    将图片按指定格式编码写入已打开的文件
+    
+    RGB 图片保存为 JPEG 且安装了 PyTurboJPEG 时使用 libjpeg-turbo 直接编码，
+    参数与 PIL 的 quality=95 保持一致（4:2:0 色度抽样）；其他情况使用 PIL，
+    JPEG 关闭哈夫曼表优化和渐进式编码，PNG 使用 SAVE_PNG_COMPRESS_LEVEL 压缩级别
+    """
+    if save_format == "JPEG":
+        if _TURBOJPEG is not None and pil_image.mode == "RGB":
+            f.write(_TURBOJPEG.encode(
+                np.asarray(pil_image), quality=95, pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420
+            ))
+        else:
+            pil_image.save(f, format="JPEG", quality=95, subsampling=2, optimize=False, progressive=False)
+    elif save_format == "PNG":
+        pil_image.save(f, format="PNG", compress_level=SAVE_PNG_COMPRESS_LEVEL, optimize=False)
+    else:
+        pil_image.save(f, format=save_format, quality=95)
+
+
+def _save_via_tmpfile(pil_image, fd, output_folder, filename, save_format):
+    """
+    将图片写入 O_TMPFILE 临时文件后以不冲突的文件名发布
+    
+    Returns:
+        str: 保存的文件路径；系统不允许链接临时文件时返回 None（由调用方改用常规方式保存）
+    """
+    with os.fdopen(fd, 'wb') as f:
+        try:
+            _write_image(pil_image, f, save_format)
+            f.flush()
+        except Exception as e:
+            # 临时文件没有文件名，关闭后自动释放，无需清理
+            logger.error(f"保存图片失败 {filename}: {str(e)}")
+            raise
+        
+        # 必须使用 linkat(AT_SYMLINK_FOLLOW)：直接 link("/proc/self/fd/N") 会链接符号链接本身而失败
+        proc_fd = os.open("/proc/self/fd", os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            output_path = _claim_output_path(
+                output_folder, filename,
+                create=lambda path: os.link(str(fd), path, src_dir_fd=proc_fd, follow_symlinks=True)
+            )
+        except OSError as e:
+            logger.debug("无法链接临时文件，改用常规方式保存: %s", e)
+            return None
+        finally:
+            os.close(proc_fd)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("已保存: %s", os.path.basename(output_path))
+    return output_path
+
+
+@functools.lru_cache(maxsize=1024)
+def _ensured(folder):
+    """
+    创建文件夹（如果不存在），每个进程内同一路径只执行一次 makedirs
+    
+    文件夹在运行期间被删除时，调用方需执行 _ensured.cache_clear() 后重新调用
+    
+    Args:
+        folder (str): 文件夹路径
+        
+    Returns:
+        str: 文件夹路径
+    """
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
 def save_image_to_folder(pil_image, output_folder, filename):
     """
     保存PIL图片到文件夹（自动重命名避免覆盖）
@@ -1508,33 +2525,74 @@ def save_image_to_folder(pil_image, output_folder, filename):
     if not output_folder:
         raise ValueError("输出文件夹路径不能为空")
     
-    # 创建输出文件夹（如果不存在）
-    os.makedirs(output_folder, exist_ok=True)
+    # 创建输出文件夹（如果不存在）；已确认存在的文件夹不再重复遍历路径
+    _ensured(output_folder)
     
-    # 构建完整路径
-    output_path = os.path.join(output_folder, filename)
+    # Linux：先写入匿名临时文件，写完后再链接到最终文件名
+    save_format = Image.registered_extensions().get(os.path.splitext(filename)[1].lower())
+    if _O_TMPFILE_SUPPORTED and save_format:
+        try:
+            fd = os.open(output_folder, os.O_TMPFILE | os.O_WRONLY, 0o666)  # 由 umask 决定最终权限
+        except OSError:
+            fd = None  # 所在文件系统不支持 O_TMPFILE，使用下面的常规方式
+        if fd is not None:
+            output_path = _save_via_tmpfile(pil_image, fd, output_folder, filename, save_format)
+            if output_path is not None:
+                return output_path
     
     # 防覆盖：如果文件已存在，自动添加 _1, _2, _3... 后缀
-    if os.path.exists(output_path):
-        # 拆分文件名和扩展名
-        name, ext = os.path.splitext(filename)
-        counter = 1
-        
-        # 寻找可用的文件名
-        while True:
-            new_filename = f"{name}_{counter}{ext}"
-            output_path = os.path.join(output_folder, new_filename)
-            if not os.path.exists(output_path):
-                logger.debug(f"文件已存在，重命名: {filename} -> {new_filename}")
-                break
-            counter += 1
+    try:
+        output_path = _claim_output_path(output_folder, filename)
+    except FileNotFoundError:
+        # 文件夹在缓存之后被删除：清除缓存，重新创建后再试一次
+        _ensured.cache_clear()
+        _ensured(output_folder)
+        output_path = _claim_output_path(output_folder, filename)
     
     # 保存图片
     try:
-        pil_image.save(output_path, quality=95)
-        saved_filename = os.path.basename(output_path)
-        logger.debug(f"已保存: {saved_filename}")
+        if save_format:
+            with open(output_path, 'wb') as f:
+                _write_image(pil_image, f, save_format)
+        else:
+            pil_image.save(output_path, quality=95)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("已保存: %s", os.path.basename(output_path))
         return output_path
     except Exception as e:
+        # 保存失败时删除已占用的空文件，并从文件名缓存中移除
+        try:
+            os.remove(output_path)
+        except OSError:
+            pass
+        _release_output_name(output_folder, os.path.basename(output_path))
         logger.error(f"保存图片失败 {filename}: {str(e)}")
         raise
+
+
+def save_images_to_folder(pil_images, filenames, output_folder):
+    """
+    批量保存图片到文件夹，多于一张时并发编码和写入（PNG/JPEG 编码时会释放 GIL）
+    
+    文件名冲突的处理与 save_image_to_folder 相同（由文件名缓存加锁保证并发安全）
+    
+    Args:
+        pil_images (list): PIL图片对象列表
+        filenames (list): 文件名列表，与 pil_images 一一对应
+        output_folder (str): 输出文件夹路径
+        
+    Returns:
+        list: 保存的文件路径列表，顺序与 pil_images 一致
+    """
+    if len(pil_images) != len(filenames):
+        raise ValueError(f"图片数量 ({len(pil_images)}) 与文件名数量 ({len(filenames)}) 不一致")
+    
+    if len(pil_images) <= 1:
+        return [save_image_to_folder(img, output_folder, name) for img, name in zip(pil_images, filenames)]
+    
+    max_workers = min(8, os.cpu_count() or 1, len(pil_images))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(
+            lambda item: save_image_to_folder(item[0], output_folder, item[1]),
+            zip(pil_images, filenames)
+        ))